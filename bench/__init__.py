@@ -0,0 +1,6 @@
+# Benchmarks for interlinearized.py
+#
+#   python -m bench.generate -o corpus.xml --texts 50     (write a synthetic export)
+#   python -m bench.run                                    (run the benchmarks)
+#
+# See bench/run.py for the options.
@@ -0,0 +1,164 @@
+# Seeded generator for synthetic FLEx "Verifiable generic XML" exports
+#
+# The structure follows what interlinearized.py reads:
+#
+#   document/interlinear-text/item            titles, title-abbreviation, source
+#   .../paragraphs/paragraph/phrases/word     a phrase (FLEx calls it <word>)
+#   .../word/words/word                       a word, with txt or punct items
+#   .../word/morphemes/morph                  a morpheme, with txt, cf and gls items
+#
+# Phrases carry free translations (gls items in en, es, eu, fr and de) and
+# sometimes a 'da' gls item of 'B', which ends a parallel text block. With
+# legacy > 0 some phrases are written as the <phrase> elements of older FLEx
+# versions, and with legacyitems=True those also get txt and 'da' items of
+# their own, which are not part of the text.
+
+import argparse
+import random
+import xml.etree.ElementTree as ET
+
+syllables = [
+    'a', 'i', 'ɨ', 'ka', 'kwa', 'kia', 'ki', 'ku', 'ma', 'mi', 'na', 'nia',
+    'ni', 'pa', 'pio', 'ri', 'ra', 'sa', 'si', 'sia', 'ta', 'ti', 'tia', 'ja',
+    'ju', 'ya', 'yi', 'ha', 'ne', 'no', 'sha',
+]
+glosses = {
+    'en': ['go', 'eat', 'see', 'house', 'river', 'big', 'dog', 'PST', '3SG',
+           'NMLZ', 'PL', 'FUT', 'DEM', 'Iquitos', 'mother', 'say', 'REP'],
+    'es': ['ir', 'comer', 'ver', 'casa', 'río', 'grande', 'perro', 'PAS',
+           '3SG', 'NMLZ', 'PL', 'FUT', 'DEM', 'Iquitos', 'madre', 'decir', 'REP'],
+}
+punctuation = ['.', ',', '?', '!', '"', "'", '“', '”', '(', ')', '-', '—', '«', '»', ':']
+tones = ['', '', '', 'H', 'L', 'HL', 'LL', 'HH', '0', '3', '4', '8']
+
+def item(parent, itemtype, lang, text):
+    e = ET.SubElement(parent, 'item', type=itemtype, lang=lang)
+    e.text = text
+    return e
+
+class Generator:
+    '''
+    Makes synthetic exports. The same seed and counts always give the same XML.
+    '''
+
+    def __init__(self, seed=0, paragraphs=20, phrases=2, words=8, morphemes=2,
+                 punct=0.15, parallel=0.2, legacy=0.0, legacyitems=False):
+        self.random = random.Random(seed)
+        self.paragraphs = paragraphs        # per text
+        self.phrases = phrases              # per paragraph
+        self.words = words                  # per phrase
+        self.morphemes = morphemes          # most morphemes per word
+        self.punct = punct                  # chance that a word is punctuation
+        self.parallel = parallel            # chance that a phrase ends a parallel block
+        self.legacy = legacy                # chance that a phrase is a <phrase>
+        self.legacyitems = legacyitems      # give <phrase>s their own txt and da items
+        self.vocabulary = [self.stem() for _ in range(400)]
+
+    def stem(self):
+        return ''.join(self.random.choice(syllables) for _ in range(self.random.randint(1, 3)))
+
+    def document(self, texts=10):
+        '''
+        Return an ElementTree with texts <interlinear-text> elements.
+        '''
+        root = ET.Element('document', version='2')
+        for textidx in range(texts):
+            self.text(root, textidx)
+        return ET.ElementTree(root)
+
+    def text(self, root, textidx):
+        r = self.random
+        text = ET.SubElement(root, 'interlinear-text', guid=f'{r.getrandbits(128):032x}')
+        name = ' '.join(r.choice(self.vocabulary) for _ in range(r.randint(1, 3)))
+        item(text, 'title', 'iqu', name.capitalize())
+        item(text, 'title', 'en', f'Story {textidx}')
+        item(text, 'title', 'es', f'Historia {textidx}')
+        item(text, 'title', 'eu', f'Cuento {textidx}')
+        item(text, 'title-abbreviation', 'en', f'BT{textidx:04d}')
+        item(text, 'source', 'eu', f'Autor {textidx % 7}')
+        paragraphs = ET.SubElement(text, 'paragraphs')
+        # The first paragraph holds the title in FLEx and is skipped.
+        for _ in range(self.paragraphs + 1):
+            self.paragraph(paragraphs)
+        return text
+
+    def paragraph(self, parent):
+        paragraph = ET.SubElement(parent, 'paragraph', guid=f'{self.random.getrandbits(64):016x}')
+        phrases = ET.SubElement(paragraph, 'phrases')
+        for phraseidx in range(self.phrases):
+            self.phrase(phrases, phraseidx)
+        return paragraph
+
+    def phrase(self, parent, phraseidx):
+        r = self.random
+        legacy = self.legacy > 0 and r.random() < self.legacy    # no draw otherwise, to keep old exports
+        phrase = ET.SubElement(parent, 'phrase' if legacy else 'word')
+        item(phrase, 'segnum', 'en', str(phraseidx + 1))
+        if legacy and self.legacyitems:
+            item(phrase, 'txt', 'iqu', 'kaa nia')
+            item(phrase, 'gls', 'da', 'B')
+        words = ET.SubElement(phrase, 'words')
+        forms = []
+        for _ in range(self.words):
+            if r.random() < self.punct:
+                word = ET.SubElement(words, 'word')
+                item(word, 'punct', 'iqu', r.choice(punctuation))
+            else:
+                forms.append(self.word(words))
+        sentence = ' '.join(forms)
+        item(phrase, 'gls', 'en', f'The {sentence} one.')
+        item(phrase, 'gls', 'es', f'El {sentence}.')
+        if r.random() < 0.5:
+            item(phrase, 'gls', 'eu', f'Lo {sentence}.')
+        if r.random() < 0.1:
+            item(phrase, 'gls', 'fr', f'Nota {sentence}')
+        if r.random() < 0.1:
+            item(phrase, 'gls', 'de', f'Note {sentence}')
+        if r.random() < self.parallel:
+            item(phrase, 'gls', 'da', 'B')
+        return phrase
+
+    def word(self, parent):
+        r = self.random
+        word = ET.SubElement(parent, 'word')
+        morphs = [r.choice(self.vocabulary) for _ in range(r.randint(1, self.morphemes))]
+        form = ''.join(morphs)
+        if r.random() < 0.03:
+            form = f'«{form}»'
+        elif r.random() < 0.03:
+            form = f'‹{form}›'
+        item(word, 'txt', 'iqu', form)
+        morphemes = ET.SubElement(word, 'morphemes')
+        for morphidx, morph in enumerate(morphs):
+            m = ET.SubElement(morphemes, 'morph', type='stem' if morphidx == 0 else 'suffix')
+            txt = morph if morphidx == 0 else '-' + morph
+            item(m, 'txt', 'iqu', txt)
+            item(m, 'cf', 'iqu', txt + r.choice(tones))
+            glossidx = r.randrange(len(glosses['en']))
+            item(m, 'gls', 'en', glosses['en'][glossidx])
+            item(m, 'gls', 'es', glosses['es'][glossidx])
+        item(word, 'gls', 'en', glosses['en'][r.randrange(len(glosses['en']))])
+        return form
+
+def generate(path, texts=10, seed=0, **counts):
+    '''
+    Write a synthetic export with texts texts to path. counts are passed on
+    to Generator (paragraphs, phrases, words, morphemes, ...).
+    '''
+    Generator(seed, **counts).document(texts).write(path, encoding='utf-8', xml_declaration=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic FLEx interlinear XML export.')
+    parser.add_argument('-o', '--output', required=True, help='XML file to write')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--texts', type=int, default=10)
+    parser.add_argument('--paragraphs', type=int, default=20, help='per text')
+    parser.add_argument('--phrases', type=int, default=2, help='per paragraph')
+    parser.add_argument('--words', type=int, default=8, help='per phrase')
+    parser.add_argument('--morphemes', type=int, default=2, help='most morphemes per word')
+    args = parser.parse_args(argv)
+    generate(args.output, texts=args.texts, seed=args.seed, paragraphs=args.paragraphs,
+             phrases=args.phrases, words=args.words, morphemes=args.morphemes)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# The orthography and small caps functions as they were before they were
+# compiled into interlinearized.Orthography and rewritten, kept as the
+# reference that the current ones are checked and timed against.
+
+import re
+
+from interlinearized import vchars, vchars_not_i, cchars
+
+def toSmallCaps(word):
+    newword = ''
+    incaps = False          # Are we in a \textsc{} environment already?
+    for idx, char in enumerate(word):
+        try:
+            # Don't convert first letter of capitalized words to small caps, e.g. Iquitos
+            canlower = not word[idx+1] in 'abcdefghijklmnopqrstuvwxyz'
+        except IndexError:
+            canlower = True
+        if canlower and char in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
+            if not incaps:
+                newword += r'\D{'
+                incaps = True
+            newword += char.lower()
+        elif char == '.':
+            newword += char
+        else:
+            if incaps:
+                incaps = False
+                newword += '}'
+            newword += char
+    if incaps: newword += '}'
+    return newword
+
+def replace_tones(w):
+    '''
+    Replace H|L with latex replacements.
+    '''
+    return re.sub('(HH|LL|HL|H|L)', r'\\super{\1}', w)
+
+def replace_nums(w):
+    '''
+    Replace numerals with latex replacements.
+    '''
+    mapdict = {
+        '0': r'\super{HL}Ø',
+        '1': r'Ø',
+        '2': r'\super{HLL}Ø',
+        '3': r'\super{H}Ø\super{LL}',
+        '4': r'\super{H}Ø\super{LL}',
+        '5': r'Ø',
+        '6': r'\super{H}Ø\super{LL}',
+        '7': r'Ø',
+        '8': r'\super{H}Ø\super{LL}'
+    }
+    return w.translate(str.maketrans(mapdict))
+
+def replace_spellings(w):
+    '''
+    Do spelling replacements. Portions of strings in « » are not modified.
+    '''
+    parts = re.split(r'(«[^»]*»)', w)
+
+    for i in range(len(parts)):
+        # Even indices are outside the brackets (modifiable text)
+        # Odd indices are inside the brackets (protected text)
+        if i % 2 == 0:
+            w = parts[i]
+            w = re.sub(rf'(k|K)w([{vchars}])', r'\1ʷ\2', w)
+            w = re.sub(r'[nN](ì|Ì|í|Í|i|I)(à|À|á|Á|a|A)', r'ɲ\2', w)
+
+            # These must be ordered.
+            w = re.sub(r'[sS]([ìÌíÍiI])([àÀáÁaAùÙúÚuU])', r'ʃ\1\2', w)
+            w = re.sub(r'[sS]([ìÌíÍiI])', r'ʃ\1', w)
+            w = re.sub(r'‹[^›]*›', lambda m: m.group(0).replace('sh', 'ʃ'), w) # replace 'sh' with 'ʃ' inside single guillemets
+            w = w.translate(str.maketrans({'j': 'h', 'J': 'H'}))
+            w = w.translate(str.maketrans({'y': 'j', 'Y': 'J'}))
+            w = re.sub(rf'([{cchars}])i([{vchars_not_i}])', r'\1ʲ\2', w)
+            parts[i] = w
+    return ''.join(parts)
@@ -0,0 +1,445 @@
+# Benchmark runner for interlinearized.py
+#
+#   python -m bench.run                          all suites, results in bench-results.json
+#   python -m bench.run --quick --suites convert,functions
+#   python -m bench.run --compare old.json       show the change against an earlier run
+#
+# Every suite works on synthetic exports from bench.generate, so results from
+# different commits are comparable. Times are the best of --repeat runs.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import interlinearized
+from bench import reference
+from bench.generate import generate
+
+suites = {}
+
+def suite(func):
+    suites[func.__name__] = func
+    return func
+
+def best(func, repeat):
+    '''
+    Return the shortest wall time of repeat calls of func.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def peak_memory(func):
+    '''
+    Return the peak memory traced by tracemalloc while func runs, in bytes.
+    '''
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+class CountingOutput(interlinearized.MemoryOutput):
+    '''
+    MemoryOutput that counts its write calls.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, name, content):
+        self.writes += 1
+        super().write(name, content)
+
+class Context:
+    def __init__(self, workdir, quick, repeat):
+        self.workdir = workdir
+        self.quick = quick
+        self.repeat = repeat
+        self.exports = {}
+
+    def export(self, texts, **counts):
+        '''
+        Return the path of a synthetic export, generating it on first use.
+        '''
+        key = (texts, tuple(sorted(counts.items())))
+        if key not in self.exports:
+            path = os.path.join(self.workdir, f'export-{len(self.exports)}.xml')
+            generate(path, texts=texts, **counts)
+            self.exports[key] = path
+        return self.exports[key]
+
+    def corpus(self):
+        return self.export(10 if self.quick else 100)
+
+    def samples(self):
+        '''
+        Return lists of raw first lines, words, cfs and glosses from the corpus.
+        '''
+        tree = interlinearized.ET.parse(self.corpus())
+        lines, words, cfs, glosses = [], [], [], []
+        for phrase in tree.iter('phrases'):
+            line = []
+            for item in phrase.iter('item'):
+                itemtype = item.get('type')
+                if itemtype == 'txt' and item.text and not item.text.startswith('-'):
+                    words.append(item.text)
+                    line.append(item.text)
+                elif itemtype == 'cf':
+                    cfs.append(item.text)
+                elif itemtype == 'gls' and item.get('lang') == 'en' and item.text and len(item.text) < 12:
+                    glosses.append(item.text)
+            lines.append(' '.join(line))
+        return lines, words, cfs, glosses
+
+@suite
+def convert(ctx):
+    '''
+    Whole conversion of the corpus, to memory and to disk, and per text.
+    '''
+    path = ctx.corpus()
+    texts = 10 if ctx.quick else 100
+    results = {}
+    results['convert.memory'] = best(lambda: interlinearized.convert(path, interlinearized.MemoryOutput()), ctx.repeat)
+    results['convert.stream'] = best(lambda: interlinearized.convert(path, interlinearized.MemoryOutput(), stream=True), ctx.repeat)
+    outdir = os.path.join(ctx.workdir, 'out')
+    results['convert.files'] = best(lambda: interlinearized.convert(path, outdir), ctx.repeat)
+    results['convert.per_text'] = results['convert.memory'] / texts
+
+    output = CountingOutput()
+    interlinearized.convert(path, output)
+    results['convert.writes_per_text'] = output.writes / texts
+    return results
+
+@suite
+def functions(ctx):
+    '''
+    Hot functions, in microseconds per call on strings from the corpus.
+    '''
+    lines, words, cfs, glosses = ctx.samples()
+    number = 1 if ctx.quick else 3
+    results = {}
+    def per_call(name, func, args):
+        seconds = min(timeit.repeat(lambda: [func(a) for a in args], number=number, repeat=ctx.repeat))
+        results[f'functions.{name}_us'] = seconds / number / len(args) * 1e6
+    per_call('replace_spellings', interlinearized.replace_spellings, lines)
+    per_call('replace_tones', interlinearized.replace_tones, cfs)
+    per_call('replace_nums', interlinearized.replace_nums, cfs)
+    per_call('toSmallCaps', interlinearized.toSmallCaps, glosses)
+    per_call('clean_firstline', interlinearized.clean_firstline, [' ' + w for w in words])
+    per_call('format_cf', interlinearized.format_cf, cfs)
+    return results
+
+@suite
+def orthography(ctx):
+    '''
+    The compiled Orthography against the original functions in bench.reference.
+
+    The outputs are first checked against each other on the corpus and on
+    random strings; a mismatch fails the suite.
+    '''
+    lines, words, cfs, glosses = ctx.samples()
+    rnd = random.Random(0)
+    alphabet = list('kKwWnNsSiIaAuUeEjJyYhHtTrmbɨìíàáùú«»‹› 0123HL-') + ['sh', 'kw', 'nia', 'si']
+    golden = lines + words + cfs + [
+        ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 30)))
+        for _ in range(2000 if ctx.quick else 20000)
+    ]
+    pairs = [
+        ('replace_spellings', reference.replace_spellings, interlinearized.replace_spellings),
+        ('replace_tones', reference.replace_tones, interlinearized.replace_tones),
+        ('replace_nums', reference.replace_nums, interlinearized.replace_nums),
+        ('toSmallCaps', reference.toSmallCaps, interlinearized.toSmallCaps),
+    ]
+    for name, old, new in pairs:
+        for w in golden + glosses:
+            if old(w) != new(w):
+                raise AssertionError(f'{name}({w!r}): {old(w)!r} != {new(w)!r}')
+
+    results = {}
+    number = 1 if ctx.quick else 3
+    for name, old, new in pairs:
+        args = glosses if name == 'toSmallCaps' else lines + cfs
+        oldtime = min(timeit.repeat(lambda: [old(a) for a in args], number=number, repeat=ctx.repeat))
+        newtime = min(timeit.repeat(lambda: [new(a) for a in args], number=number, repeat=ctx.repeat))
+        results[f'orthography.{name}.reference'] = oldtime
+        results[f'orthography.{name}.current'] = newtime
+        results[f'orthography.{name}.speedup'] = oldtime / newtime
+    return results
+
+@suite
+def scaling(ctx):
+    '''
+    Time per morpheme in one ever longer paragraph, which should stay flat.
+    '''
+    results = {}
+    for phrases in ((10, 20, 40) if ctx.quick else (25, 50, 100, 200)):
+        path = ctx.export(1, paragraphs=1, phrases=phrases, words=10, morphemes=2, seed=phrases)
+        tree = interlinearized.ET.parse(path)
+        morphs = sum(1 for _ in tree.iter('morph'))
+        seconds = best(lambda: interlinearized.convert(path, interlinearized.MemoryOutput()), ctx.repeat)
+        results[f'scaling.{phrases}_phrases.us_per_morph'] = seconds / morphs * 1e6
+    return results
+
+@suite
+def memory(ctx):
+    '''
+    Peak traced memory of a conversion, read whole and streamed, as the
+    number of texts grows. Streaming should stay about flat.
+    '''
+    results = {}
+    for texts in ((5, 20) if ctx.quick else (25, 100, 400)):
+        path = ctx.export(texts)
+        for stream in (False, True):
+            peak = peak_memory(lambda: interlinearized.convert(path, interlinearized.MemoryOutput(), stream=stream))
+            # MemoryOutput keeps the output, which is not the converter's own
+            # memory, so count it out.
+            output = interlinearized.MemoryOutput()
+            interlinearized.convert(path, output, stream=stream)
+            kept = sum(len(content.encode('utf-8')) for content in output.files.values())
+            mode = 'stream' if stream else 'tree'
+            results[f'memory.{texts}_texts.{mode}_mb'] = (peak - kept) / 2**20
+    return results
+
+@suite
+def models(ctx):
+    '''
+    Memory per morpheme of the parsed ElementTree against the Text models,
+    and the time to read the XML against loading the models from a ModelCache.
+    '''
+    path = ctx.corpus()
+    cache = interlinearized.ModelCache(os.path.join(ctx.workdir, 'models'))
+    interlinearized.convert(path, interlinearized.MemoryOutput(), model_cache=cache)
+    tree = interlinearized.ET.parse(path)
+    morphs = sum(1 for _ in tree.iter('morph'))
+    del tree
+
+    def traced(func):
+        tracemalloc.start()
+        try:
+            kept = func()   # alive while measuring
+            return tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+    results = {}
+    results['models.etree_bytes_per_morph'] = traced(lambda: interlinearized.ET.parse(path)) / morphs
+    results['models.model_bytes_per_morph'] = traced(lambda: list(cache.load(path))) / morphs
+    results['models.parse'] = best(lambda: [interlinearized.parse_text(t) for t in interlinearized.iter_texts(path)], ctx.repeat)
+    results['models.load'] = best(lambda: list(cache.load(path)), ctx.repeat)
+    results['models.convert.cached'] = best(lambda: interlinearized.convert(path, interlinearized.MemoryOutput(), model_cache=cache), ctx.repeat)
+    return results
+
+@suite
+def backends(ctx):
+    '''
+    ElementTree against lxml, if it is installed. The output of both is
+    first checked to be the same, 2-line and 4-line, read whole and
+    streamed; a difference fails the suite. So is an export with legacy
+    <phrase> elements, whose own items must not change the output.
+    '''
+    path = ctx.corpus()
+    texts = 10 if ctx.quick else 100
+    legacy = ctx.export(texts, legacy=0.3)
+    legacyitems = ctx.export(texts, legacy=0.3, legacyitems=True)
+    names = ['etree'] + (['lxml'] if interlinearized.lxml_etree is not None else [])
+    results = {}
+    try:
+        outputs = {}
+        for name in names:
+            interlinearized.set_xml_backend(name)
+            plain, withitems = interlinearized.MemoryOutput(), interlinearized.MemoryOutput()
+            interlinearized.convert(legacy, plain)
+            interlinearized.convert(legacyitems, withitems)
+            if plain.files != withitems.files:
+                raise AssertionError(f'{name}: the items of a <phrase> change the output')
+            for fourline in (True, False):
+                for stream in (False, True):
+                    output = interlinearized.MemoryOutput()
+                    interlinearized.convert(path, output, fourline=fourline, stream=stream)
+                    if outputs.setdefault((fourline, stream), output.files) != output.files:
+                        raise AssertionError(f'{name} output differs (fourline={fourline}, stream={stream})')
+            results[f'backends.{name}.convert'] = best(
+                lambda: interlinearized.convert(path, interlinearized.MemoryOutput()), ctx.repeat)
+            results[f'backends.{name}.parse'] = best(
+                lambda: [interlinearized.parse_text(t) for t in interlinearized.iter_texts(path)], ctx.repeat)
+    finally:
+        interlinearized.set_xml_backend('etree')
+    return results
+
+@suite
+def jobs(ctx):
+    '''
+    Conversion time and speedup with --jobs across core counts.
+    '''
+    path = ctx.corpus()
+    cpus = os.cpu_count() or 1
+    counts = sorted({1, 2, 4, cpus} if not ctx.quick else {1, 2})
+    results = {}
+    serial = None
+    for n in counts:
+        seconds = best(lambda: interlinearized.convert(path, interlinearized.MemoryOutput(), jobs=n), ctx.repeat)
+        serial = serial or seconds
+        results[f'jobs.{n}.seconds'] = seconds
+        results[f'jobs.{n}.speedup'] = serial / seconds
+    results['jobs.cpus'] = cpus
+    return results
+
+@suite
+def index(ctx):
+    '''
+    Conversion with and without a MorphIndex, the time to index an
+    unchanged export again, and lookups by exact form, gloss and wildcard.
+    '''
+    path = ctx.corpus()
+    dbpath = os.path.join(ctx.workdir, 'index.db')
+    results = {}
+    results['index.convert.plain'] = best(lambda: interlinearized.convert(path, interlinearized.MemoryOutput()), ctx.repeat)
+
+    def fresh():
+        if os.path.exists(dbpath):
+            os.remove(dbpath)
+        interlinearized.convert(path, interlinearized.MemoryOutput(), index=dbpath)
+    results['index.convert.indexed'] = best(fresh, ctx.repeat)
+    results['index.convert.reindexed'] = best(
+        lambda: interlinearized.convert(path, interlinearized.MemoryOutput(), index=dbpath), ctx.repeat)
+
+    morphindex = interlinearized.MorphIndex(dbpath)
+    try:
+        form = morphindex.db.execute('SELECT txt FROM morphs ORDER BY id LIMIT 1').fetchone()[0]
+        for name, pattern, field in (('txt', form, 'txt'), ('gloss', 'PST', 'gloss'),
+                                     ('wildcard', form[:1] + '*', 'any')):
+            results[f'index.lookup.{name}.hits'] = len(morphindex.lookup(pattern, field))
+            results[f'index.lookup.{name}'] = best(lambda: morphindex.lookup(pattern, field), ctx.repeat)
+    finally:
+        morphindex.close()
+    return results
+
+class SlowOutput(interlinearized.FileOutput):
+    '''
+    FileOutput that waits latency seconds before each write, like a network share.
+    '''
+
+    def __init__(self, path, latency):
+        super().__init__(path)
+        self.latency = latency
+
+    def write(self, name, content):
+        time.sleep(self.latency)
+        super().write(name, content)
+
+@suite
+def writer(ctx):
+    '''
+    Conversion to disk with files written in the main thread against a
+    BackgroundWriter, on a local folder and on one with 5 ms write latency.
+    '''
+    path = ctx.corpus()
+    outdir = os.path.join(ctx.workdir, 'writer')
+    results = {}
+    for name, make in (('local', lambda: outdir), ('slow', lambda: SlowOutput(outdir, 0.005))):
+        for background in (False, True):
+            mode = 'background' if background else 'sync'
+            results[f'writer.{name}.{mode}'] = best(
+                lambda: interlinearized.convert(path, make(), background=background), ctx.repeat)
+    results['writer.local.fsync'] = best(lambda: interlinearized.convert(path, outdir, fsync=True), ctx.repeat)
+    return results
+
+@suite
+def merge(ctx):
+    '''
+    Merging three exports, two of them with the same texts, read in one
+    process and in one process per export, against reading one export.
+    '''
+    texts = 10 if ctx.quick else 100
+    paths = []
+    for exportidx, seed in enumerate((0, 1, 0)):
+        path = os.path.join(ctx.workdir, f'merge-{exportidx}.xml')
+        generate(path, texts=texts, seed=seed)
+        paths.append(path)
+    results = {}
+    results['merge.texts'] = len(interlinearized.merge_exports(paths))
+    results['merge.one_export'] = best(lambda: interlinearized.read_export(paths[0]), ctx.repeat)
+    results['merge.serial'] = best(lambda: interlinearized.merge_exports(paths), ctx.repeat)
+    results['merge.parallel'] = best(lambda: interlinearized.merge_exports(paths, jobs=len(paths)), ctx.repeat)
+    results['merge.cpus'] = os.cpu_count()
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results, old):
+    '''
+    Return lines comparing results with an earlier results dict.
+    '''
+    lines = [f'{"benchmark":<48} {"before":>12} {"after":>12} {"change":>8}']
+    for name, value in results.items():
+        if name in old and isinstance(value, (int, float)) and old[name]:
+            lines.append(f'{name:<48} {old[name]:>12.4g} {value:>12.4g} {value / old[name] - 1:>+8.1%}')
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark interlinearized.py on synthetic exports.')
+    parser.add_argument('--suites', default=','.join(suites),
+                        help='comma-separated suites to run (default: %(default)s)')
+    parser.add_argument('--quick', action='store_true', help='small inputs, for a fast check')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement (default: %(default)s)')
+    parser.add_argument('-o', '--output', default='bench-results.json',
+                        help='JSON file to save the results to (default: %(default)s)')
+    parser.add_argument('--compare', metavar='JSON', help='results of an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    names = [name for name in args.suites.split(',') if name]
+    for name in names:
+        if name not in suites:
+            parser.error(f'unknown suite: {name}')
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        ctx = Context(workdir, args.quick, args.repeat)
+        for name in names:
+            start = time.perf_counter()
+            results.update(suites[name](ctx))
+            print(f'{name}: done in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'quick': args.quick,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            old = json.load(f)['results']
+        print('\n'.join(compare(results, old)))
+    else:
+        for name, value in results.items():
+            print(f'{name:<48} {value:>12.4g}')
+
+if __name__ == '__main__':
+    main()
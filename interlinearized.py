@@ -1,12 +1,41 @@
 # Script for converting interlinearized FLEx texts into LaTeX
 # Greg Finley, March 2013
+#
+# Usage:
+#   python interlinearized.py                      (pick a file in the GUI)
+#   python interlinearized.py [options] XML [XML ...]
+#
+# Run with --help for the batch options. The conversion itself is available
+# to other scripts as convert().
 
 import sys, os, shutil, re
+import argparse
+import collections
+import concurrent.futures
+import cProfile
+import functools
+import hashlib
+import json
+import mmap
+import pickle
+import queue
+import sqlite3
+import threading
 import xml.etree.ElementTree as ET
 import datetime
 import string
-import tkinter
-from tkinter import filedialog
+import time
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:     # lxml is optional; the standard library parser is used instead
+    lxml_etree = None
+
+try:
+    import tkinter
+    from tkinter import filedialog
+except ImportError:     # Headless installs without Tk can still run in batch mode
+    tkinter = None
 
 encoding = 'utf-8'
 
@@ -15,50 +44,39 @@ vchars = 'àÀáÁaAèÈéÉeEìÌíÍiIƗɨòÒóÓoOùÙúÚuU'
 vchars_not_i = 'àÀáÁaAèÈéÉeEƗɨòÒóÓoOùÙúÚuU'
 cchars = 'bBcCdDfFgGhHjJkKlLmMnNpPqQrRsStTvVwWxXyYzZ'
 
-class Application(tkinter.Frame):
+if tkinter is not None:
+    class Application(tkinter.Frame):
 
-    def createWidgets(self):
-        self.msg = tkinter.Message(self)
-        self.msg["text"] = """
+        def createWidgets(self):
+            self.msg = tkinter.Message(self)
+            self.msg["text"] = """
 Give me an XML file of interlinearized text output from FLEx and I'll do the rest.
-        """
-        self.msg.pack()
-
-        self.go = tkinter.Button(self)
-        self.go["text"] = "Begin!"
-        self.go["command"] = self.letsgo
-        self.go.pack()
-
-        self.morph = tkinter.Checkbutton(self)
-        self.morphbox = tkinter.IntVar()
-        self.morph["variable"] = self.morphbox
-        self.morph["text"] = "4-line output?"
-        self.morph.select()
-        self.morph.pack()
-
-    def letsgo(self):
-        self.makedic=True
-        self.quit()
-
-    def __init__(self, master=None):
-        tkinter.Frame.__init__(self, master)
-        self.pack()
-        self.master.title("FLEx-TeX")
-        self.createWidgets()
-        self.makedic = False
+            """
+            self.msg.pack()
 
-app = Application()
-app.mainloop()
-if not app.makedic: os._exit(0)
+            self.go = tkinter.Button(self)
+            self.go["text"] = "Begin!"
+            self.go["command"] = self.letsgo
+            self.go.pack()
 
-xmlfilemsg = "XML file from FLEx?"
-xmlfile = filedialog.askopenfilename(title = xmlfilemsg)
+            self.morph = tkinter.Checkbutton(self)
+            self.morphbox = tkinter.IntVar()
+            self.morph["variable"] = self.morphbox
+            self.morph["text"] = "4-line output?"
+            self.morph.select()
+            self.morph.pack()
 
-if not xmlfile: os._exit(0)
+        def letsgo(self):
+            self.makedic=True
+            self.quit()
 
-fourline = app.morphbox.get()       # Are we doing a 4-line interlinearization?
+        def __init__(self, master=None):
+            tkinter.Frame.__init__(self, master)
+            self.pack()
+            self.master.title("FLEx-TeX")
+            self.createWidgets()
+            self.makedic = False
 
-app.master.destroy()
 
 # ~~~~~~~~~
 # Functions
@@ -77,28 +95,26 @@ def killspace(line) :
 # Also for morpheme glosses: replace caps with LaTeX small caps
 
 def toSmallCaps(word):
-    newword = ''
+    newword = []
     incaps = False          # Are we in a \textsc{} environment already?
+    lastidx = len(word) - 1
     for idx, char in enumerate(word):
-        try:
-            # Don't convert first letter of capitalized words to small caps, e.g. Iquitos
-            canlower = not word[idx+1] in 'abcdefghijklmnopqrstuvwxyz'
-        except IndexError:
-            canlower = True
+        # Don't convert first letter of capitalized words to small caps, e.g. Iquitos
+        canlower = idx == lastidx or not word[idx+1] in 'abcdefghijklmnopqrstuvwxyz'
         if canlower and char in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
             if not incaps:
-                newword += r'\D{'
+                newword.append(r'\D{')
                 incaps = True
-            newword += char.lower()
+            newword.append(char.lower())
         elif char == '.':
-            newword += char
+            newword.append(char)
         else:
             if incaps:
                 incaps = False
-                newword += '}'
-            newword += char
-    if incaps: newword += '}'
-    return newword
+                newword.append('}')
+            newword.append(char)
+    if incaps: newword.append('}')
+    return ''.join(newword)
 
 # Encloses a (translation) line in single quotes
 
@@ -120,79 +136,251 @@ def clean_title(textitle):
             print(f'type(title) {type(title)}')
     return textitle
 
+onlydigits = re.compile(r'\s*\d+\s*')
+digits = re.compile(r'\d')
+
 def clean_firstline(w, community=False):
     '''
     Process text for first interlinear line.
     '''
-    if re.match(r'^\s*\d+\s*$', w) and community is False:
+    if community is False and onlydigits.fullmatch(w):
         return ' {}'
-    w = re.sub(r'\d', '', w)
+    w = digits.sub('', w)
     if community is False:
         w = w.replace('=', '')
     return w
 
-def replace_tones(w):
+class Orthography:
+    '''
+    Iquito orthography rules, compiled once.
+
+    spellings() gives the same result as applying the rules one after the
+    other, but does it in one regex scan and one str.translate() per
+    unprotected stretch of text.
+    '''
+
+    def __init__(self):
+        self.protected = re.compile(r'(«[^»]*»)')
+        # The rules can be matched in a single scan because each one starts
+        # with a different consonant and none of them can create a match
+        # for another. Alternatives are tried in the order the rules were
+        # applied in, so e.g. "nia" is ɲa and not nʲa.
+        self.rules = re.compile(
+            r'(?P<guil>‹[^›]*›)'                        # 'sh' is 'ʃ' inside single guillemets
+            rf'|(?P<kw>[kK])w(?=[{vchars}])'            # kw -> kʷ before vowels
+            r'|(?P<ny>[nN][ìÌíÍiI])(?=[àÀáÁaA])'        # nia -> ɲa
+            r'|(?P<sh>[sS])(?=[ìÌíÍiI])'                 # si -> ʃi
+            rf'|(?P<pal>[{cchars}])i(?=[{vchars_not_i}])'   # Cia -> Cʲa
+        )
+        # j -> h, then y -> j. This can come after the scan above because
+        # all four letters are consonants either way.
+        self.letters = str.maketrans({'j': 'h', 'J': 'H', 'y': 'j', 'Y': 'J'})
+        self.tonepattern = re.compile('(HH|LL|HL|H|L)')
+        self.numbers = str.maketrans({
+            '0': r'\super{HL}Ø',
+            '1': r'Ø',
+            '2': r'\super{HLL}Ø',
+            '3': r'\super{H}Ø\super{LL}',
+            '4': r'\super{H}Ø\super{LL}',
+            '5': r'Ø',
+            '6': r'\super{H}Ø\super{LL}',
+            '7': r'Ø',
+            '8': r'\super{H}Ø\super{LL}'
+        })
+
+    def _rule(self, m):
+        rule = m.lastgroup
+        if rule == 'kw':
+            return m.group('kw') + 'ʷ'
+        if rule == 'ny':
+            return 'ɲ'
+        if rule == 'sh':
+            return 'ʃ'
+        if rule == 'pal':
+            return m.group('pal') + 'ʲ'
+        inner = m.group('guil')[1:-1].replace('sh', 'ʃ')
+        return '‹' + self.rules.sub(self._rule, inner) + '›'
+
+    def spellings(self, w):
+        '''
+        Do spelling replacements. Portions of strings in « » are not modified.
+        '''
+        if '«' not in w:
+            return self.rules.sub(self._rule, w).translate(self.letters)
+        parts = self.protected.split(w)
+        # Even indices are outside the brackets (modifiable text)
+        # Odd indices are inside the brackets (protected text)
+        for i in range(0, len(parts), 2):
+            parts[i] = self.rules.sub(self._rule, parts[i]).translate(self.letters)
+        return ''.join(parts)
+
+    def tones(self, w):
+        '''
+        Replace H|L with latex replacements.
+        '''
+        return self.tonepattern.sub(r'\\super{\1}', w)
+
+    def nums(self, w):
+        '''
+        Replace numerals with latex replacements.
+        '''
+        return w.translate(self.numbers)
+
+orthography = Orthography()
+replace_tones = orthography.tones
+replace_nums = orthography.nums
+replace_spellings = orthography.spellings
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~
+# Morpheme formatting cache
+# ~~~~~~~~~~~~~~~~~~~~~~~~
+
+# The same cfs and glosses occur over and over in a corpus, so their
+# formatting is cached, keyed on the raw string from the XML.
+
+default_cache_size = 65536
+
+def format_cf(cf):
     '''
-    Replace H|L with latex replacements.
+    Format a raw cf for the second line.
     '''
-    return re.sub('(HH|LL|HL|H|L)', r'\\super{\1}', w)
+    return replace_nums(replace_spellings(replace_tones(killspace(cf))))
 
-def replace_nums(w):
+def format_gloss(gls):
     '''
-    Replace numerals with latex replacements.
+    Format a raw morpheme gloss for the third line.
     '''
-    mapdict = {
-        '0': r'\super{HL}Ø',
-        '1': r'Ø',
-        '2': r'\super{HLL}Ø',
-        '3': r'\super{H}Ø\super{LL}',
-        '4': r'\super{H}Ø\super{LL}',
-        '5': r'Ø',
-        '6': r'\super{H}Ø\super{LL}',
-        '7': r'Ø',
-        '8': r'\super{H}Ø\super{LL}'
-    }
-    return w.translate(str.maketrans(mapdict))
+    return toSmallCaps(killspace(gls))
 
-def replace_spellings(w):
+class FormatCache:
     '''
-    Do spelling replacements. Portions of strings in « » are not modified.
+    Bounded LRU cache around a string formatting function.
+
+    Call lookup() to format a string. Besides the lru_cache hit and miss
+    counts, the time spent formatting on misses is recorded so that the time
+    saved by the hits can be estimated.
     '''
-    parts = re.split(r'(«[^»]*»)', w)
 
-    for i in range(len(parts)):
-        # Even indices are outside the brackets (modifiable text)
-        # Odd indices are inside the brackets (protected text)
-        if i % 2 == 0:
-            w = parts[i]
-            w = re.sub(rf'(k|K)w([{vchars}])', r'\1ʷ\2', w)
-            w = re.sub(r'[nN](ì|Ì|í|Í|i|I)(à|À|á|Á|a|A)', r'ɲ\2', w)
-
-            # These must be ordered.
-            w = re.sub(r'[sS]([ìÌíÍiI])([àÀáÁaAùÙúÚuU])', r'ʃ\1\2', w)
-            w = re.sub(r'[sS]([ìÌíÍiI])', r'ʃ\1', w)
-            w = re.sub(r'‹[^›]*›', lambda m: m.group(0).replace('sh', 'ʃ'), w) # replace 'sh' with 'ʃ' inside single guillemets
-            w = w.translate(str.maketrans({'j': 'h', 'J': 'H'}))
-            w = w.translate(str.maketrans({'y': 'j', 'Y': 'J'}))
-            w = re.sub(rf'([{cchars}])i([{vchars_not_i}])', r'\1ʲ\2', w)
-            parts[i] = w
-    return ''.join(parts)
+    def __init__(self, func, maxsize=default_cache_size):
+        self.func = func
+        self.resize(maxsize)
+
+    def resize(self, maxsize):
+        '''
+        Start over with an empty cache of at most maxsize entries (0 disables caching).
+        '''
+        self.maxsize = maxsize
+        self.misstime = 0.0
+        self.absorbed = {'hits': 0, 'misses': 0, 'misstime': 0.0}
+        self.lookup = functools.lru_cache(maxsize)(self._format)
+
+    def _format(self, s):
+        start = time.perf_counter()
+        value = self.func(s)
+        self.misstime += time.perf_counter() - start
+        return value
+
+    def stats(self):
+        '''
+        Return the hit and miss counts and the time spent on misses.
+        '''
+        info = self.lookup.cache_info()
+        return {
+            'hits': info.hits + self.absorbed['hits'],
+            'misses': info.misses + self.absorbed['misses'],
+            'misstime': self.misstime + self.absorbed['misstime'],
+        }
+
+    def absorb(self, stats):
+        '''
+        Add stats() from another process to this cache's counts.
+        '''
+        for key in self.absorbed:
+            self.absorbed[key] += stats[key]
+
+format_caches = {
+    'cf': FormatCache(format_cf),
+    'gloss': FormatCache(format_gloss),
+}
+cached_cf = format_caches['cf']
+cached_gloss = format_caches['gloss']
+
+def set_cache_size(maxsize):
+    '''
+    Empty the formatting caches and limit each to maxsize entries.
+    '''
+    for cache in format_caches.values():
+        cache.resize(maxsize)
+
+def cache_stats():
+    return {name: cache.stats() for name, cache in format_caches.items()}
+
+def format_cache_stats():
+    '''
+    Return a small report of the formatting cache hit rates and the time saved.
+    '''
+    lines = [f'{"cache":<6} {"size":>8} {"hits":>10} {"misses":>10} {"hit rate":>9} {"time saved":>11}']
+    for name, cache in format_caches.items():
+        stats = cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        hitrate = stats['hits'] / lookups if lookups else 0.0
+        # Each hit saves about as long as an average miss takes
+        saved = stats['hits'] * stats['misstime'] / stats['misses'] if stats['misses'] else 0.0
+        lines.append(f'{name:<6} {cache.maxsize:>8} {stats["hits"]:>10} {stats["misses"]:>10} {hitrate:>9.1%} {saved:>10.3f}s')
+    return '\n'.join(lines) + '\n'
 
 # ~~~~~~~~~~~~~~
 # Variable setup
 # ~~~~~~~~~~~~~~
 
-now = datetime.datetime.now()
 thispath = os.path.dirname(sys.argv[0])
-if len(sys.argv) > 1:
-    xmlargument = sys.argv[1]
 title = ""
 masterfilename = "__inputs.tex"
+manifestname = ".interlinearized-manifest.json"   # for incremental runs
+
+# LaTeX build shards (convert(shards=True))
+includesfilename = "__includes.tex"             # \include{}s the wrapper of each text
+includeonlyfilename = "__includeonly.tex"       # \includeonly{} of the texts written in the last run
+includefolder = "__include"
+previewfolder = "__preview"
+preamblename = "__preamble"     # written by the user: the preamble of the master document
 
 # THIS will have to be changed to reflect the language used!
 # It is set up now for Matsigenka.
 titlelang = 'iqu'
 
+# How to write each gloss language: the title macros in the order they are
+# written, the free translation tiers as (macro, translation language, quote it?),
+# and the translation language for the right column of the parallel text file
+# (None for no parallel file). Add an entry here to support another language.
+glosslang_formats = {
+    'en': {
+        'titles': {
+            'iqu': r'%\titi{',
+            'en': r'%\tite{',
+        },
+        'tiers': [
+            (r'\glt', 'en', True),
+            (r'\gltfn', 'de', False),
+        ],
+        'parallel': 'en',
+    },
+    'es': {
+        'titles': {
+            'iqu': r'%\titi{',
+            'eu': r'%\titc{',
+            'es': r'%\tits{',
+        },
+        'tiers': [
+            (r'\glts', 'es', True),
+            (r'\gltc', 'eu', True),
+            (r'\gltcfn', 'fr', False),
+        ],
+        'parallel': None,
+    },
+}
+glosslangs = ('en', 'es')
+
 # Get rid of characters disliked by Windows...
 badwin = r':"%/<>^|\?*'
 # ...and LaTeX.
@@ -202,322 +390,2039 @@ illegalchars = badwin + badtex
 # Also: characters that are bad for the text title in LaTeX
 badtitle = "_#"
 
-# ~~~~~~~~~~~~~~~
-# File operations
-# ~~~~~~~~~~~~~~~
+# ~~~~~~~~~~~~
+# XML backends
+# ~~~~~~~~~~~~
 
-newpath = str(now.year) + "-" + str(now.month).zfill(2) + "-" + str(now.day).zfill(2) + "_" + str(now.hour).zfill(2) + str(now.minute).zfill(2)
-newpath = os.path.join(thispath,newpath)
-newcommpath = os.path.join(newpath, 'community')
-defaultpath = os.path.join(thispath,"default")
+class XMLBackend:
+    '''
+    The XML library that exports are read with: the standard library's
+    ElementTree, or lxml. Their elements have the same API. With lxml the
+    item lookups in select run as compiled XPath; with ElementTree they are
+    done in Python, which is faster there than its own XPath support. Both
+    give the same Texts.
+
+    lxml parses about twice as fast, but every element it hands back is a
+    new proxy object, and on our exports that costs more than the parsing
+    saves. So ElementTree is the default; 'auto' picks lxml if it is
+    installed. bench.run --suites backends compares the two.
+    '''
 
-if not os.path.exists(newpath):
-    os.makedirs(newpath)
-if not os.path.exists(newcommpath):
-    os.makedirs(newcommpath)
+    # selector -> XPath of the items it finds, relative to an element
+    paths = {
+        'items': 'item',                    # the titles of a text
+        'typed': 'item[@type]',             # the items of a phrase
+        'worditems': './/word/item[@type]', # the items of the words of a phrase
+        'morphitems': './/item[@type]',     # the items of a morpheme
+    }
 
-masterfile = open(os.path.join(newpath, masterfilename),'w', encoding=encoding)
-#masterfile.write("\\newcommand{\\texttitle}[1]{\chapter{#1}\setcounter{equation}{0}}\n")
+    def __init__(self, name='auto'):
+        if name == 'auto':
+            name = 'etree' if lxml_etree is None else 'lxml'
+        if name == 'lxml':
+            if lxml_etree is None:
+                raise ValueError('lxml is not installed')
+            self.etree = lxml_etree
+            self.errors = (lxml_etree.XMLSyntaxError,)
+            self.select = {key: lxml_etree.XPath(path) for key, path in self.paths.items()}
+        elif name == 'etree':
+            self.etree = ET
+            self.errors = (ET.ParseError,)
+            self.select = {
+                'items': lambda elem: [item for item in elem if item.tag == 'item'],
+                'typed': lambda elem: [item for item in elem if item.tag == 'item' and 'type' in item.attrib],
+                'worditems': lambda elem: [item for word in elem.iter('word') if word is not elem
+                                           for item in word if item.tag == 'item' and 'type' in item.attrib],
+                'morphitems': lambda elem: [item for item in elem.iter('item') if 'type' in item.attrib],
+            }
+        else:
+            raise ValueError(f'unknown XML backend: {name}')
+        self.name = name
 
-# Get the XML. This is where most of the processing happens.
+xmllib = XMLBackend('etree')
 
-try:
-    tree = ET.parse(xmlfile)
-except:
-    print("No XML file found. Exiting.")
-    os._exit(0)
-root = tree.getroot()
-
-# ~~~~~~~~~~~~~~~~~~~~
-# Go through each text
-# ~~~~~~~~~~~~~~~~~~~~
-for glosslang in ('en', 'es'):
-    for text in root.findall('interlinear-text'):
-        # Get the title and format it into three different versions
-        lang_to_title_type = {
-            'en': {
-                'iqu': r'%\titi{',
-                'en': r'%\tite{',
-            },
-            'es': {
-                'iqu': r'%\titi{',
-                'eu': r'%\titc{',
-                'es': r'%\tits{',
-            }
-        }
+def set_xml_backend(name):
+    '''
+    Read exports with the XMLBackend name ('lxml', 'etree' or 'auto').
+    '''
+    global xmllib
+    xmllib = XMLBackend(name)
+
+# ~~~~~~~~~~
+# Text model
+# ~~~~~~~~~~
+
+# The XML is read once into these objects. Everything that does not depend on
+# the gloss language (titles, the first line, cfs) is normalized here, so that
+# writing another gloss language only costs the rendering step.
+#
+# The classes use __slots__, and the strings and gloss dicts that repeat from
+# morpheme to morpheme are interned, so a model takes a fraction of the
+# memory of the elements it was read from. Models can be kept on disk between
+# runs in a ModelCache.
+
+class Text:
+    __slots__ = ('guid', 'titles', 'rawtitle', 'titleabbr', 'author', 'paragraphs')
+
+    def __init__(self):
+        self.guid = None
+        self.titles = {}            # title language -> cleaned title
+        self.rawtitle = None        # title in titlelang, for file names
+        self.titleabbr = 'NOT FOUND'
+        self.author = 'NOT FOUND'
+        self.paragraphs = []
+
+class Paragraph:
+    __slots__ = ('fullline', 'commfullline', 'phrases', 'translations', 'endparallel')
+
+    def __init__(self):
+        self.fullline = ''          # first line of text
+        self.commfullline = ''      # first line of text, community text output
+        self.phrases = []
+        self.translations = {}      # language -> free translation, the last phrase's winning
+        self.endparallel = False    # does a parallel text block end here?
+
+class Phrase:
+    __slots__ = ('words', 'translations')
+
+    def __init__(self, words, translations):
+        self.words = words          # Words that have morphemes
+        self.translations = translations
+
+    # Pickled as their fields, which is smaller and quicker to load than the
+    # default for classes with __slots__; there are many of these.
+    def __reduce__(self):
+        return Phrase, (self.words, self.translations)
+
+class Word:
+    __slots__ = ('morphs',)
+
+    def __init__(self, morphs):
+        self.morphs = morphs
+
+    def __reduce__(self):
+        return Word, (self.morphs,)
+
+class Morph:
+    __slots__ = ('txt', 'cf', 'glosses')
+
+    def __init__(self, txt, cf, glosses):
+        self.txt = txt              # text, with killspace() applied
+        self.cf = cf                # cf, fully normalized
+        self.glosses = glosses      # language -> raw gloss; shared, do not change
+
+    def __reduce__(self):
+        return Morph, (self.txt, self.cf, self.glosses)
+
+glosssets = {}      # gloss items -> the one dict used for them
+
+def intern_glosses(glosses):
+    '''
+    Return a dict equal to glosses that is shared by every morpheme with the
+    same glosses.
+    '''
+    return glosssets.setdefault(tuple(glosses.items()), glosses)
 
-        titlesection = ''
-        titleabbr = 'NOT FOUND'
-        author = 'NOT FOUND'
-        for titleitem in text.findall('item'):
-            if 'type' in titleitem.attrib and titleitem.attrib['type'] == 'title':
-                titext = clean_title(titleitem.text)
-                if titleitem.attrib['lang'] == 'iqu':   # process \titi value
-                    titext = clean_firstline(titext)
-                try:
-                    lang_to_title_type[glosslang][titleitem.attrib['lang']] += titext
-                except KeyError:  # skip extra <item type="title" lang="XX"> elements
+def parse_text(text):
+    '''
+    Read an <interlinear-text> element into a Text.
+    '''
+    model = parse_titles(text)
+
+    # Go through each "paragraph". The first one is skipped.
+    for paragraphidx, paragraph in enumerate(text.iter('paragraph')):
+        if paragraphidx == 0:
+            continue
+        model.paragraphs.append(parse_paragraph(paragraph))
+    return model
+
+def parse_titles(text):
+    '''
+    Read the title items of an <interlinear-text> element into a Text
+    without any paragraphs.
+    '''
+    model = Text()
+    model.guid = text.get('guid')
+    for titleitem in xmllib.select['items'](text):
+        itemtype = titleitem.attrib.get('type')
+        lang = titleitem.attrib.get('lang')
+        if itemtype == 'title':
+            titext = clean_title(titleitem.text)
+            if lang == 'iqu':   # process \titi value
+                titext = clean_firstline(titext)
+            model.titles[lang] = model.titles.get(lang, '') + titext
+            # Save rawtitle for the title in the language we want
+            if lang == titlelang:
+                model.rawtitle = titleitem.text
+        elif itemtype == 'title-abbreviation':
+            model.titleabbr = titleitem.text
+        elif itemtype == 'source' and lang == 'eu':
+            model.author = r'\auth{' + titleitem.text + '}'
+    if model.rawtitle is None:
+        model.rawtitle = model.titleabbr
+    return model
+
+def parse_paragraph(paragraph):
+    '''
+    Read a <paragraph> element into a Paragraph.
+    '''
+    model = Paragraph()
+
+#   This is how it used to work. Then FLEx started putting 'word' under each 'phrases' XML tag for some reason.
+#    phrases = paragraph.iter('phrase')
+
+#   This is how it works now. Goes into <phrases> and then finds all the <word> tags (which used to be <phrase>) immediately under that.
+    phrases = []
+    phrasesblock = paragraph.find('phrases')
+    if not phrasesblock == None:
+        phrases = phrasesblock.findall('word') + phrasesblock.findall('phrase')
+
+    typed = xmllib.select['typed']
+    phraseitems = [typed(phrase) for phrase in phrases]
+    parse_firstline(phrases, phraseitems, model)
+
+    # Get free translation (held within <phrase>) for the last line.
+    # A later phrase's translation replaces an earlier one.
+
+    for phrase, items in zip(phrases, phraseitems):
+        translations = {}
+        for item in items:
+            if item.get('type') == 'gls':
+                translations[sys.intern(item.get('lang'))] = item.text or ""
+        model.phrases.append(Phrase(parse_words(phrase), translations))
+    if len(model.phrases) == 1:
+        model.translations = model.phrases[0].translations
+    else:
+        for phrase in model.phrases:
+            model.translations.update(phrase.translations)
+    return model
+
+def parse_firstline(phrases, phraseitems, model):
+    '''
+    Build the first line (glossed and community versions) of a paragraph
+    from its phrases, and note whether a parallel text block ends there.
+    phraseitems holds the typed items of each phrase itself.
+
+    The words and punctuation of all the phrases are collected as tokens
+    in one pass, and both versions are then joined from the same tokens.
+    '''
+    worditems = xmllib.select['worditems']
+    tokens = []     # (text, spaced); spaced tokens get a leading space
+    for phrase, ownitems in zip(phrases, phraseitems):
+
+        # String together all the words for the first line. A <word> phrase
+        # is a word itself, and its own items come first; those of a legacy
+        # <phrase> are not part of the line.
+
+        in_single_quote = False
+        in_double_quote = False
+        for items in ((ownitems, worditems(phrase)) if phrase.tag == 'word' else (worditems(phrase),)):
+            for item in items:
+                itemtype = item.get('type')
+                itemtext = item.text
+
+                # Check for end of parallel text block
+                if itemtype == 'gls' and item.attrib['lang'] == 'da' and itemtext is not None and itemtext.strip() == 'B':
+                    model.endparallel = True
                     continue
-                # Save rawtitle for the title in the language we want
-                if 'lang' in titleitem.attrib and titleitem.attrib['lang'] == titlelang:
-                    rawtitle = titleitem.text
-            elif 'type' in titleitem.attrib and titleitem.attrib['type'] == 'title-abbreviation':
-                titleabbr = titleitem.text
-            elif 'type' in titleitem.attrib and titleitem.attrib['type'] == 'source' and  'lang' in titleitem.attrib and titleitem.attrib['lang'] == 'eu':
-                author = r'\auth{' + titleitem.text + '}'
-        lang_to_title_type[glosslang]['iqu'] += f' ({titleabbr})'   # append to \titi line
-
-        title = rawtitle        # title to use for filenames and \include{}
-        for char in illegalchars:
-            try:
-                title = title.replace(char,"_")
-            except:
-                print(char)
-                print(f'type(char) {type(char)}')
-                print(f'type(title) {type(title)}')
-        #titleascii = title.decode(encoding)
-        titleascii = title
-
-        fname = f'{titleabbr}-{glosslang}-glossed.tex'
-        nextfilepath = os.path.join(newpath, fname)
-        while os.path.exists(nextfilepath):
-            nextfilepath = os.path.join(newpath, fname + '2')     # There's a better way to do this
-        nextcommfilepath = os.path.join(newcommpath, titleascii + ".tex")
-        while os.path.exists(nextcommfilepath):
-            nextcommfilepath = os.path.join(newcommpath, fname + '2')     # There's a better way to do this
-
-        # Open up a new output file for each text
-        outfile = open(nextfilepath,'w', encoding=encoding)
-        outfile.write('}\n'.join(lang_to_title_type[glosslang].values()) + '}\n')
-        outfile.write(author + '\n\n')
-
-        if glosslang == 'en':
-            parallelfile = open(nextfilepath.replace('glossed', 'parallel'),'w', encoding=encoding)
-            parallelfile.write('}\n'.join(lang_to_title_type[glosslang].values()) + '}\n')
-            parallelfile.write(author + '\n\n')
-
-        outcommfile = open(nextcommfilepath,'w', encoding=encoding)
-        outcommfile.write('}\n'.join(lang_to_title_type[glosslang].values()) + '}\n')
-        outcommfile.write(author + '\n\n')
-
-        masterfile.write("\\input{" + fname + "}\n")
-
-        # Go through each "paragraph" and print the 4-line interlinearization for each
-
-        paralleltexts = {'left': [], 'right': []}
-        endparallelblock = False
-        for paragraphidx, paragraph in enumerate(text.iter('paragraph')):
-            if paragraphidx == 0:
-                continue
 
-            fullline = ''       # first line of text
-            commfullline = ''   # first line of text, community text output
-            linemorphs = []     # contains all morphemes in a given paragraph/line
+                # Add a leading space if it's not punctuation.
+
+                if itemtype == 'txt' or itemtype == 'cf':
+                    if in_single_quote or in_double_quote:
+                        tokens.append((itemtext, False))
+                    else:
+                        # Replace regular space with nonbreaking space character ~ within item
+                        tokens.append((itemtext.replace(' ', '~'), True))
+                elif itemtype == 'punct':
+                    if itemtext in ("'", '"'):
+                        tokens.append((itemtext, True))
+                        if itemtext == "'":
+                            in_single_quote = not in_single_quote
+                        if itemtext == '"':
+                            in_double_quote = not in_double_quote
+                        continue
+                    if itemtext is None:
+                        sys.stderr.write('Empty punctuation found\n')
+                        xmllib.etree.dump(item)
+                    if itemtext != "\\":    # Kill weird backslashes
+                        tokens.append((itemtext or '', False))
+
+    model.fullline = join_firstline(tokens)
+    model.commfullline = join_firstline(tokens, community=True)
+
+# Punctuation that should not behave like other punctuation:
+leftsidepunc = ["“", "``", "`", "«", "\xe2\x80\x98", "(", "[", "{", "\xe2\x80\x9c"]
+nospacepunc = ["-", "\xe2\x80\x94", "\xe2\x80\x93", "»"]
+
+def join_firstline(tokens, community=False):
+    '''
+    Join the tokens of a first line, as collected by parse_firstline(), into
+    its glossed or community version. Every step runs once over the line.
+    '''
+    parts = []
+    for text, spaced in tokens:
+        if spaced:
+            text = " " + text
+        if community is False and onlydigits.fullmatch(text):
+            text = ' {}'
+        parts.append(text)
+    line = digits.sub('', ''.join(parts))
+
+    # Post-processing:
+    if community is False:
+        line = line.replace('=', '')
+    for punc in leftsidepunc:
+        line = line.replace(punc + " ", " " + punc)
+    if community is False:
+        for punc in nospacepunc:
+            line = line.replace(punc + " ", punc)
+    else:
+        # Add space before emdash
+        line = line.replace('—', ' —')
+    # Remove leading space (necessary?)
+    if line[:1] == ' ': line = line[1:]
+    if community is False:
+        line = replace_spellings(line)
+    return line
+
+def parse_words(phrase):
+    '''
+    Go through morphemes for second and third lines. Returns a Word for each
+    <morphemes> in phrase. Glosses are kept for every language and picked
+    when rendering.
+    '''
+    morphitems = xmllib.select['morphitems']
+    words = []
+    for morphword in phrase.iter('morphemes'):
+        morphs = []
+        for morpheme in morphword.iter('morph'):
+            txt = ""    # text for each morpheme
+            cf = ""     # cf for each morpheme
+            glosses = {}
+            for item in morphitems(morpheme):
+                itemtype = item.get('type')
+                if itemtype == 'txt':
+                    txt = sys.intern(killspace(item.text)) #.encode("utf-8")
+                    # TODO: escape badtex chars here, e.g. #
+                elif itemtype == 'cf':
+                    cf = sys.intern(cached_cf.lookup(item.text))
+                elif itemtype == 'gls':
+                    gls = item.text
+                    glosses[sys.intern(item.get('lang'))] = gls and sys.intern(gls)
+            morphs.append(Morph(txt, cf, intern_glosses(glosses)))
+        words.append(Word(morphs))
+    return words
+
+# ~~~~~~~~~
+# Rendering
+# ~~~~~~~~~
+
+def render_title(text, glosslang):
+    '''
+    Return the title and author lines that start each output file.
+    '''
+    titles = []
+    for lang, macro in glosslang_formats[glosslang]['titles'].items():
+        titext = macro + text.titles.get(lang, '')
+        if lang == 'iqu':
+            titext += f' ({text.titleabbr})'   # append to \titi line
+        titles.append(titext)
+    return '}\n'.join(titles) + '}\n' + text.author + '\n\n'
+
+def render_gloss(morph, glosslang):
+    '''
+    Return the gloss of a morpheme in glosslang, formatted for the third line.
+    '''
+    gls = cached_gloss.lookup(morph.glosses.get(glosslang))
+    txt = morph.txt
+
+    # Add a hyphen to the beginning or end of a gloss morpheme if the corresponding text has it.
+    if len(txt) and len(gls):
+        if txt[0] == '-' and gls[0] != '-':
+            gls = '-' + gls
+        if txt[-1] == '-' and gls[-1] != '-':
+            gls = gls + '-'
+    return gls
+
+# Each example is built as one block of lines joined together, and
+# hash_escape() is run once over the block. The \label line is left out of
+# the escaping, as it always has been.
+
+def render_parallel(paralleltexts):
+    return (r'\begin{Parallel}{0.47\textwidth}{0.47\textwidth}' + '\n'
+            + r' \ParallelLText{\noindent \textit{' + ' '.join(paralleltexts['left']) + '}}\n'
+            + r' \ParallelRText{\noindent \textit{' + ' '.join(paralleltexts['right']) + '}}\n'
+            + r'\end{Parallel}' + '\n')
+
+def render_label(text, paragraphidx):
+    return "\\ea\\label{ex:" + f'{text.titleabbr}{paragraphidx}' + "}\n"
+
+def render_glossed(text, glosslang, fourline):
+    '''
+    Return the interlinearization of text in glosslang, and its parallel
+    text version (None if glosslang has no parallel file).
+    '''
+    fmt = glosslang_formats[glosslang]
+    header = render_title(text, glosslang)
+    out = [header]
+    parallel = [header] if fmt['parallel'] is not None else None
+
+    paralleltexts = {'left': [], 'right': []}
+    for paragraphidx, paragraph in enumerate(text.paragraphs, 1):
+        block = []
+        if fourline:
+            block.append("\\glll \n")
+        block.append(paragraph.fullline + r"\\" + "\n")
+        if parallel is not None:
+            paralleltexts['left'].append(paragraph.fullline)
+            paralleltexts['right'].append(paragraph.translations.get(fmt['parallel'], ''))
+            if paragraph.endparallel:
+                parallel.append(hash_escape(render_parallel(paralleltexts)))
+                paralleltexts = {'left': [], 'right': []}
+        if fourline:
             linecfs = []        # contains all cfs in a given paragraph/line
             lineglosses = []    # contains all glosses in a given paragraph/line
-            translation = ''    # English free translation for each line
-            sptranslation = ''    # Spanish (local variety) free translation for each line
-            spntranslation = ''    # Spanish (standard variety) free translation for each line
-            spnfnote = ''    # Spanish (standard variety) footnote for each line
-            engfnote = ''    # English footnote for each line
-
-    #       This is how it used to work. Then FLEx started putting 'word' under each 'phrases' XML tag for some reason.
-    #        phrases = paragraph.iter('phrase')
-
-    #       This is how it works now. Goes into <phrases> and then finds all the <word> tags (which used to be <phrase>) immediately under that.
-            phrasesblock = paragraph.find('phrases')
-            if not phrasesblock == None:
-                phrases = phrasesblock.findall('word') + phrasesblock.findall('phrase')
-
-            for phrase in phrases:
-
-                # String together all the words for the first line
-
-                words = phrase.iter('word')
-
-                in_single_quote = False
-                in_double_quote = False
-                for widx, word in enumerate(words):
-                    for item in word:
-                        if item.tag == "item" and 'type' in item.attrib:
-
-                            # Check for end of parallel text block
-                            if item.attrib['type'] == 'gls' and item.attrib['lang'] == 'da' and item.text is not None and item.text.strip() == 'B':
-                                endparallelblock = True
-                                continue
-
-                            # Encode the word to add to the string.
-                            # Add a leading space if it's not punctuation.
-
-                            if item.attrib['type'] == 'txt' or item.attrib['type'] == 'cf':
-                                if in_single_quote or in_double_quote:
-                                    txt = item.text #.encode('utf-8')
-                                else:
-                                    # Replace regular space with nonbreaking space character ~ within item
-                                    nonbreakingtxt = item.text.replace(' ', '~')
-                                    txt = " " + nonbreakingtxt
-                                fullline += clean_firstline(txt)
-                                commfullline += clean_firstline(txt, community=True)
-                            if item.attrib['type'] == 'punct':
-                                if item.text in ("'", '"'):
-                                    txt = f' {item.text}'
-                                    if item.text == "'":
-                                        in_single_quote = not in_single_quote
-                                    if item.text == '"':
-                                        in_double_quote = not in_double_quote
-                                else:
-                                    txt = item.text or '' #.encode('utf-8')
-                                if item.text is None:
-                                    sys.stderr.write('Empty punctuation found\n')
-                                    ET.dump(item)
-                                if txt == "\\": txt = ''    # Kill weird backslashes
-                                fullline += clean_firstline(txt)
-                                commfullline += clean_firstline(txt, community=True)
-
-                            if paragraphidx == 0 and item.attrib['type'] == 'gls':
-                                # Special handling of first paragraph
-                                if 'lang' in item.attrib and item.attrib['lang'] == 'en':
-                                    translation = item.text
-                                elif 'lang' in item.attrib and item.attrib['lang'] == 'es':
-                                    sptranslation = item.text
-                                elif 'lang' in item.attrib and item.attrib['lang'] == 'eu':
-                                    spntranslation = item.text
-
-
-                # Post-processing:
-                # Punctuation that should not behave like other punctuation:
-                leftsidepunc = ["“", "``", "`", "«", "\xe2\x80\x98", "(", "[", "{", "\xe2\x80\x9c"]
-                for punc in leftsidepunc:
-                    fullline = fullline.replace(punc + " ", " " + punc)
-                    commfullline = commfullline.replace(punc + " ", " " + punc)
-                nospacepunc = ["-", "\xe2\x80\x94", "\xe2\x80\x93", "»"]
-                for punc in nospacepunc:
-                    fullline = fullline.replace(punc + " ", punc)
-                # Add space before emdash
-                commfullline = commfullline.replace('—', ' —')
-                # Remove leading space (necessary?)
-                if fullline[0] == ' ': fullline = fullline[1:]
-                fullline = replace_spellings(fullline)
-                if commfullline[0] == ' ': commfullline = commfullline[1:]
-
-                # Go through morphemes for second and third lines
-
-                for morphword in paragraph.iter('morphemes'):
-                    for morpheme in morphword.iter('morph'):
-                        txt = ""    # text for each morpheme
-                        cf = ""     # cf for each morpheme
-                        gls = ""    # gloss for each morpheme
-                        for item in morpheme.iter('item'):
-                            if 'type' in item.attrib:
-                                if item.attrib['type'] == 'txt':
-                                    txt = killspace(item.text) #.encode("utf-8")
-                                    # TODO: escape badtex chars here, e.g. #
-                                if item.attrib['type'] == 'cf':
-                                    cf = killspace(item.text) #.encode("utf-8")
-                                    cf = replace_tones(cf)
-                                    cf = replace_spellings(cf)
-                                    cf = replace_nums(cf)
-                                if item.attrib['type'] == 'gls' and item.attrib['lang'] == glosslang:
-                                    gls = killspace(item.text) #.encode("utf-8")
-                                    gls = toSmallCaps(gls)
-
-                        # Add a hyphen to the beginning or end of a gloss morpheme if the corresponding text has it.
-                        if len(txt) and len(gls):
-                            if txt[0] == '-' and gls[0] != '-':
-                                gls = '-' + gls
-                            if txt[-1] == '-' and gls[-1] != '-':
-                                gls = gls + '-'
-
-                        linemorphs.append(txt)
-                        linecfs.append(cf)
-                        lineglosses.append(gls)
-                    linemorphs.append(' ')
+            for phrase in paragraph.phrases:
+                for word in phrase.words:
+                    for morph in word.morphs:
+                        linecfs.append(morph.cf)
+                        lineglosses.append(render_gloss(morph, glosslang) or "{}")
                     linecfs.append(' ')
                     lineglosses.append(' ')
+            linecfs.append(r'\\' + "\n")
+            lineglosses.append(r'\\' + "\n")
+            block.append(''.join(linecfs))
+            block.append(''.join(lineglosses))
+        for macro, lang, quote in fmt['tiers']:
+            translation = paragraph.translations.get(lang, '')
+            if translation != '':
+                if quote:
+                    translation = enclose_single(translation)
+                block.append(macro + "{" + translation + r"}\\" + "\n")
+        block.append("\\z\n\n")
+        out.append(render_label(text, paragraphidx))
+        out.append(hash_escape(''.join(block)))
+    if parallel is not None:
+        if len(paralleltexts['left']) > 0:
+            parallel.append(hash_escape(render_parallel(paralleltexts)))
+        parallel = ''.join(parallel)
+    return ''.join(out), parallel
+
+def render_community(text, glosslang):
+    '''
+    Return the community version of text, with the titles of glosslang.
+    '''
+    out = [render_title(text, glosslang)]
+    for paragraphidx, paragraph in enumerate(text.paragraphs, 1):
+        out.append(render_label(text, paragraphidx))
+        out.append(hash_escape(
+            "\\iqu{" + paragraph.commfullline + r"}\\" + "\n"
+            + "\\spq{" + paragraph.translations.get('es', '') + r"}\\" + "\n"
+            + "\\eng{" + paragraph.translations.get('en', '') + "}\n"
+            + "\\z\n\\vspace{-0.20in}\n"
+        ))
+    return ''.join(out)
+
+# ~~~~~~
+# Output
+# ~~~~~~
+
+# convert() writes whole files at a time through one of these. Names are
+# relative to the output folder and use / as separator.
+
+def write_atomic(path, content, sync=False):
+    '''
+    Write content to path by way of a temporary file, so that an interrupted
+    run never leaves path half-written. With sync=True the file is also
+    fsynced before it is renamed into place.
+    '''
+    tmppath = path + '.tmp'
+    try:
+        with open(tmppath, 'w', encoding=encoding) as f:
+            f.write(content)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmppath, path)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+class FileOutput:
+    '''
+    Output files in a folder on disk. With sync=True each file is fsynced
+    before it replaces the old one (see write_atomic()).
+    '''
 
-                    # Get free translation (held within <phrase>) for the last line
-
-                    for item in phrase:
-                        if item.tag == 'item' and 'type' in item.attrib and item.attrib['type'] == 'gls' and item.attrib['lang'] == 'en':
-                            translation = item.text
-                            if translation == None: translation = ""
-                        if item.tag == 'item' and 'type' in item.attrib and item.attrib['type'] == 'gls' and item.attrib['lang'] == 'es':
-                            sptranslation = item.text
-                            if sptranslation == None: sptranslation = ""
-                        if item.tag == 'item' and 'type' in item.attrib and item.attrib['type'] == 'gls' and item.attrib['lang'] == 'eu':
-                            spntranslation = item.text
-                            if spntranslation == None: spntranslation = ""
-                        if item.tag == 'item' and 'type' in item.attrib and item.attrib['type'] == 'gls' and item.attrib['lang'] == 'fr':
-                            spnfnote = item.text
-                            if spnfnote == None: spnfnote = ""
-                        if item.tag == 'item' and 'type' in item.attrib and item.attrib['type'] == 'gls' and item.attrib['lang'] == 'de':
-                            engfnote = item.text
-                            if engfnote == None: engfnote = ""
-
-            if paragraphidx > 0:
-                outfile.write("\\ea\\label{ex:" + f'{titleabbr}{paragraphidx}' + "}\n")
-            if fourline:
-                outfile.write("\\glll \n")
-            outfile.write(hash_escape(fullline) + r"\\" + "\n")
-            paralleltexts['left'].append(hash_escape(fullline))
-            paralleltexts['right'].append(hash_escape(translation))
-            if endparallelblock is True and glosslang == 'en':
-                parallelfile.write(r'\begin{Parallel}{0.47\textwidth}{0.47\textwidth}' + '\n')
-                parallelfile.write(r' \ParallelLText{\noindent \textit{' + ' '.join(paralleltexts['left']) + '}}\n')
-                parallelfile.write(r' \ParallelRText{\noindent \textit{' + ' '.join(paralleltexts['right']) + '}}\n')
-                parallelfile.write(r'\end{Parallel}' + '\n')
-                paralleltexts = {'left': [], 'right': []}
-                endparallelblock = False
-            if fourline:
-    #            for morph in linemorphs:
-    #                outfile.write(hash_escape(morph))
-    #            outfile.write(r'\\' + "\n")
-                for cf in linecfs:
-                    outfile.write(hash_escape(cf))
-                outfile.write(r'\\' + "\n")
-                for gls in lineglosses:
-                    if gls == '':
-                        gls = "{}"
-                    #outfile.write(gls+" ")
-                    outfile.write(hash_escape(gls))
-                outfile.write(r'\\' + "\n")
-            if sptranslation != '' and glosslang == 'es':
-                outfile.write("\\glts{" + hash_escape(enclose_single(sptranslation)) + r"}\\" + "\n")
-            if spntranslation != '' and glosslang == 'es':
-                outfile.write("\\gltc{" + hash_escape(enclose_single(spntranslation)) + r"}\\" + "\n")
-            if spnfnote != '' and glosslang == 'es':
-                outfile.write("\\gltcfn{" + hash_escape(spnfnote) + r"}\\" + "\n")
-            if translation != '' and glosslang == 'en':
-                outfile.write("\\glt{" + hash_escape(enclose_single(translation) + r"}\\") + "\n")
-            if engfnote != '' and glosslang == 'en':
-                outfile.write("\\gltfn{" + hash_escape(engfnote) + r"}\\" + "\n")
-            if paragraphidx > 0:
-                outfile.write("\\z\n")
-            outfile.write("\n")
-
-            # Community texts
-            outcommfile.write("\\ea\\label{ex:" + f'{titleabbr}{paragraphidx}' + "}\n")
-            outcommfile.write("\\iqu{" + hash_escape(commfullline) + r"}\\" + "\n")
-    #        for cf in linecfs:
-    #            outcommfile.write(hash_escape(cf))
-    #        outcommfile.write(r'\\' + "\n")
-    #        for gls in lineglosses:
-    #            if gls == '':
-    #                gls = "{}"
-    #            #outcommfile.write(gls+" ")
-    #            outcommfile.write(hash_escape(gls))
-            outcommfile.write("\\spq{" + hash_escape(sptranslation) + r"}\\" + "\n")
-            outcommfile.write("\\eng{" + hash_escape(translation) + "}\n")
-            outcommfile.write("\\z\n\\vspace{-0.20in}\n")
-        if len(paralleltexts['left']) > 0 and  glosslang == 'en':
-            parallelfile.write(r'\begin{Parallel}{0.47\textwidth}{0.47\textwidth}' + '\n')
-            parallelfile.write(r' \ParallelLText{\noindent \textit{' + ' '.join(paralleltexts['left']) + '}}\n')
-            parallelfile.write(r' \ParallelRText{\noindent \textit{' + ' '.join(paralleltexts['right']) + '}}\n')
-            parallelfile.write(r'\end{Parallel}' + '\n')
-
-        outfile.close()
-        if glosslang == 'en':
-            parallelfile.close()
-        outcommfile.close()
-
-masterfile.close()
+    def __init__(self, path, sync=False):
+        self.path = path
+        self.sync = sync
+        self.folders = set()    # folders known to exist
+
+    def _path(self, name):
+        return os.path.join(self.path, *name.split('/'))
+
+    def write(self, name, content):
+        path = self._path(name)
+        folder = os.path.dirname(path)
+        if folder not in self.folders:
+            os.makedirs(folder or '.', exist_ok=True)
+            self.folders.add(folder)
+        write_atomic(path, content, self.sync)
+
+    def read(self, name):
+        '''
+        Return the contents of name, or None if there is no such file.
+        '''
+        try:
+            with open(self._path(name), encoding=encoding) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, name):
+        return os.path.exists(self._path(name))
+
+    def remove(self, name):
+        if os.path.exists(self._path(name)):
+            os.remove(self._path(name))
+
+class MemoryOutput:
+    '''
+    Output files kept in memory, in the dict files of name -> contents,
+    e.g. for tests or for callers that want the LaTeX without any files.
+    '''
+
+    def __init__(self, files=None):
+        self.path = ''
+        self.files = {} if files is None else files
+
+    def write(self, name, content):
+        self.files[name] = content
+
+    def read(self, name):
+        return self.files.get(name)
+
+    def exists(self, name):
+        return name in self.files
+
+    def remove(self, name):
+        self.files.pop(name, None)
+
+class BackgroundWriter:
+    '''
+    Writes the files of an output (e.g. a FileOutput) in background
+    threads, so that rendering goes on while finished texts are written.
+    With several threads, the latency of a network share is overlapped
+    too. Files may be written in any order; call wait() to make sure all
+    the files so far are written.
+
+    At most queuesize files wait to be written; write() blocks while the
+    queue is full. If a write fails, the files queued after it are dropped
+    and the error is raised by the next write() or by close(). exists()
+    counts queued files too; read() and remove() wait for the queue to
+    empty first. Call close() when done, to wait for the last files.
+    '''
+
+    def __init__(self, output, threads=4, queuesize=64):
+        self.output = output
+        self.path = output.path
+        self.queue = queue.Queue(queuesize)
+        self.queued = set()     # names waiting in the queue
+        self.error = None
+        self.threads = [threading.Thread(target=self.run, name='output writer', daemon=True)
+                        for _ in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            name, content = item
+            if self.error is None:
+                try:
+                    self.output.write(name, content)
+                except BaseException as e:
+                    self.error = e
+            self.queued.discard(name)
+            self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, name, content):
+        self.check()
+        if not self.threads:
+            raise ValueError('write to a closed BackgroundWriter')
+        if name in self.queued:
+            self.wait()     # The last write to a file must win
+        self.queued.add(name)
+        self.queue.put((name, content))
+
+    def wait(self):
+        '''
+        Wait until every queued file is written.
+        '''
+        self.queue.join()
+        self.check()
+
+    def read(self, name):
+        self.wait()
+        return self.output.read(name)
+
+    def exists(self, name):
+        return name in self.queued or self.output.exists(name)
+
+    def remove(self, name):
+        self.wait()
+        self.output.remove(name)
+
+    def close(self):
+        '''
+        Write the files still queued and stop the thread.
+        '''
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.check()
+
+# ~~~~~~~~~~~
+# Model cache
+# ~~~~~~~~~~~
+
+default_model_cache = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'interlinearized')
+
+@functools.lru_cache(maxsize=None)
+def script_digest():
+    '''
+    Return a digest of this script, which every cached result depends on.
+    '''
+    with open(__file__, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class ModelCache:
+    '''
+    Keeps the Text models read from each export in a folder, so that
+    converting the same export again, with any settings, skips the XML.
+
+    There is one file per export, named after its path. It holds a header
+    with the export's size, mtime and content hash and a digest of this
+    script, then one pickled Text per text, so that they can be read back
+    one at a time. The models are used if the script is the same and the
+    export has the same size and either the same mtime or, failing that,
+    the same content hash.
+    '''
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, xml_path):
+        key = hashlib.sha1(os.path.abspath(xml_path).encode(encoding)).hexdigest()
+        return os.path.join(self.folder, key + '.pickle')
+
+    def load(self, xml_path):
+        '''
+        Return a list of the cached Texts of xml_path, or None if there are
+        none or they are out of date.
+        '''
+        try:
+            f = open(self.path(xml_path), 'rb')
+        except OSError:
+            return None
+        with f:
+            try:
+                header = pickle.load(f)
+                st = os.stat(xml_path)
+                if not (header['script'] == script_digest() and header['size'] == st.st_size
+                        and (header['mtime'] == st.st_mtime_ns or header['hash'] == file_digest(xml_path))):
+                    return None
+                # All of them now, so that a text that cannot be read is a miss
+                # too rather than an error halfway through a conversion
+                return list(self.texts(f))
+            except Exception:   # A damaged or foreign cache file is just a miss
+                return None
+
+    def texts(self, f):
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+    def writer(self, xml_path):
+        '''
+        Return a ModelCacheWriter that replaces the cached Texts of xml_path.
+        '''
+        st = os.stat(xml_path)
+        header = {
+            'script': script_digest(),
+            'size': st.st_size,
+            'mtime': st.st_mtime_ns,
+            'hash': file_digest(xml_path),
+        }
+        return ModelCacheWriter(self.path(xml_path), header)
+
+class ModelStore:
+    '''
+    Keeps the Texts of exports in memory from one conversion to the next,
+    as the model_cache of convert() in --watch mode. Each load() only scans
+    the raw bytes of the export and parses just the <interlinear-text>
+    elements whose content is new since the last load.
+    '''
+
+    def __init__(self):
+        self.exports = {}   # xml_path -> [(content hash, Text)] in document order
+
+    def load(self, xml_path):
+        previous = dict(self.exports.get(xml_path, ()))
+
+        def model(span):
+            digest = hashlib.sha1(span).hexdigest()
+            text = previous.get(digest)
+            if text is None:
+                text = previous[digest] = parse_text(xmllib.etree.fromstring(span))
+            return digest, text
+
+        current = self.exports[xml_path] = scan_text_spans(xml_path, model)
+        return [text for digest, text in current]
+
+    def forget(self, xml_path):
+        self.exports.pop(xml_path, None)
+
+class ModelCacheWriter:
+    '''
+    Writes the Texts of one export, in order, to a temporary file that
+    commit() moves into place.
+    '''
+
+    def __init__(self, path, header):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.tmppath = f'{path}.{os.getpid()}.tmp'
+        self.file = open(self.tmppath, 'wb')
+        pickle.dump(header, self.file, pickle.HIGHEST_PROTOCOL)
+
+    def add(self, text):
+        '''
+        Add a Text, or a Text already pickled (by a worker process).
+        '''
+        if not isinstance(text, bytes):
+            text = pickle.dumps(text, pickle.HIGHEST_PROTOCOL)
+        self.file.write(text)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.tmppath, self.path)
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.tmppath)
+
+# ~~~~~~~~~~~~~~~
+# Morpheme index
+# ~~~~~~~~~~~~~~~
+
+class MorphIndex:
+    '''
+    A SQLite concordance of converted texts: each morpheme with its txt, cf
+    and glosses, under the example (ex:{titleabbr}{n}) and text it is in,
+    plus the first line and free translations of each example.
+
+    Texts are added as they are converted and written in batches of
+    batchsize texts, one transaction per batch. A text that is added again
+    replaces its old rows, unless it has not changed. Call begin() before
+    the texts of an export and end() after them.
+    '''
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS texts (
+            id INTEGER PRIMARY KEY, export TEXT, textkey TEXT, digest TEXT,
+            guid TEXT, abbr TEXT, title TEXT);
+        CREATE TABLE IF NOT EXISTS examples (
+            id INTEGER PRIMARY KEY, text INTEGER, number INTEGER, label TEXT, line TEXT);
+        CREATE TABLE IF NOT EXISTS translations (
+            example INTEGER, lang TEXT, translation TEXT);
+        CREATE TABLE IF NOT EXISTS morphs (
+            id INTEGER PRIMARY KEY, example INTEGER, word INTEGER, position INTEGER,
+            txt TEXT COLLATE NOCASE, cf TEXT COLLATE NOCASE);
+        CREATE TABLE IF NOT EXISTS glosses (
+            morph INTEGER, lang TEXT, gloss TEXT COLLATE NOCASE);
+        CREATE UNIQUE INDEX IF NOT EXISTS texts_key ON texts (export, textkey);
+        CREATE INDEX IF NOT EXISTS examples_text ON examples (text);
+        CREATE INDEX IF NOT EXISTS translations_example ON translations (example);
+        CREATE INDEX IF NOT EXISTS morphs_example ON morphs (example);
+        CREATE INDEX IF NOT EXISTS morphs_txt ON morphs (txt);
+        CREATE INDEX IF NOT EXISTS morphs_cf ON morphs (cf);
+        CREATE INDEX IF NOT EXISTS glosses_morph ON glosses (morph);
+        CREATE INDEX IF NOT EXISTS glosses_gloss ON glosses (gloss);
+    '''
+
+    def __init__(self, path, batchsize=50):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.schema)
+        self.batchsize = batchsize
+        self.pending = []
+        self.export = None
+        self.added = set()      # text keys added since begin()
+        self.digests = {}       # text key -> digest of its indexed Text, for this export
+
+    def begin(self, export):
+        '''
+        Start on the texts of export: the absolute path of an export, or a
+        name for a merged set of them.
+        '''
+        self.flush()
+        self.export = export
+        self.added = set()
+        self.digests = dict(self.db.execute(
+            'SELECT textkey, digest FROM texts WHERE export = ?', (self.export,)))
+
+    def add(self, text, pickled=None):
+        '''
+        Queue text to be written. pickled is the pickled text, if at hand.
+        '''
+        if pickled is None:
+            pickled = pickle.dumps(text, pickle.HIGHEST_PROTOCOL)
+        self.pending.append((text, hashlib.sha1(pickled).hexdigest()))
+        if len(self.pending) >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the pending texts in one transaction.
+        '''
+        if not self.pending:
+            return
+        rows = {'texts': [], 'examples': [], 'translations': [], 'morphs': [], 'glosses': []}
+        with self.db:
+            nextids = {table: self.db.execute(f'SELECT coalesce(max(id), 0) + 1 FROM {table}').fetchone()[0]
+                       for table in ('texts', 'examples', 'morphs')}
+            for text, digest in self.pending:
+                key = text.guid or text.titleabbr
+                if key in self.added:       # texts without a guid that share a title abbreviation
+                    key = f'{key}#{sum(1 for k in self.added if k.startswith(key + "#")) + 2}'
+                self.added.add(key)
+                if self.digests.get(key) == digest:
+                    continue
+                if key in self.digests:
+                    self.remove(key)
+                self.digests[key] = digest
+                textid = nextids['texts']
+                nextids['texts'] += 1
+                rows['texts'].append((textid, self.export, key, digest, text.guid, text.titleabbr, text.rawtitle))
+                for number, paragraph in enumerate(text.paragraphs, 1):
+                    exampleid = nextids['examples']
+                    nextids['examples'] += 1
+                    rows['examples'].append((exampleid, textid, number, f'ex:{text.titleabbr}{number}', paragraph.fullline))
+                    for lang, translation in paragraph.translations.items():
+                        rows['translations'].append((exampleid, lang, translation))
+                    wordidx = 0
+                    for phrase in paragraph.phrases:
+                        for word in phrase.words:
+                            wordidx += 1
+                            for position, morph in enumerate(word.morphs, 1):
+                                morphid = nextids['morphs']
+                                nextids['morphs'] += 1
+                                rows['morphs'].append((morphid, exampleid, wordidx, position, morph.txt, morph.cf))
+                                for lang, gloss in morph.glosses.items():
+                                    rows['glosses'].append((morphid, lang, gloss))
+            for table, tablerows in rows.items():
+                if tablerows:
+                    marks = ', '.join('?' * len(tablerows[0]))
+                    self.db.executemany(f'INSERT INTO {table} VALUES ({marks})', tablerows)
+        self.pending = []
+
+    def remove(self, key):
+        '''
+        Delete the rows of a text of the current export.
+        '''
+        texts = 'SELECT id FROM texts WHERE export = ? AND textkey = ?'
+        examples = f'SELECT id FROM examples WHERE text IN ({texts})'
+        morphs = f'SELECT id FROM morphs WHERE example IN ({examples})'
+        args = (self.export, key)
+        self.db.execute(f'DELETE FROM glosses WHERE morph IN ({morphs})', args)
+        self.db.execute(f'DELETE FROM morphs WHERE example IN ({examples})', args)
+        self.db.execute(f'DELETE FROM translations WHERE example IN ({examples})', args)
+        self.db.execute(f'DELETE FROM examples WHERE text IN ({texts})', args)
+        self.db.execute('DELETE FROM texts WHERE export = ? AND textkey = ?', args)
+
+    def end(self, complete=True):
+        '''
+        Write the texts still pending. If the whole export was added
+        (complete), also drop the texts that are no longer in it.
+        '''
+        self.flush()
+        if complete:
+            with self.db:
+                for (key,) in self.db.execute('SELECT textkey FROM texts WHERE export = ?', (self.export,)).fetchall():
+                    if key not in self.added:
+                        self.remove(key)
+                        del self.digests[key]
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def lookup(self, pattern, field='any', limit=None):
+        '''
+        Return (label, txt, cf, glosses, line) for each morpheme whose txt,
+        cf or gloss (or just the one field) matches pattern, case
+        insensitively. * and ? in pattern are wildcards. glosses is a dict
+        of language to gloss.
+        '''
+        if '*' in pattern or '?' in pattern:
+            pattern = pattern.replace('%', r'\%').replace('_', r'\_').replace('*', '%').replace('?', '_')
+            match = "LIKE ? ESCAPE '\\'"
+        else:
+            match = '= ?'
+        conditions = {
+            'txt': f'morphs.txt {match}',
+            'cf': f'morphs.cf {match}',
+            'gloss': f'morphs.id IN (SELECT morph FROM glosses WHERE gloss {match})',
+        }
+        fields = list(conditions) if field == 'any' else [field]
+        matches = f'SELECT id FROM morphs WHERE {" OR ".join(conditions[f] for f in fields)} ORDER BY id'
+        if limit is not None:
+            matches += f' LIMIT {int(limit)}'
+        query = f'''
+            SELECT morphs.id, examples.label, morphs.txt, morphs.cf, examples.line, glosses.lang, glosses.gloss
+            FROM ({matches}) AS matched
+            JOIN morphs ON morphs.id = matched.id
+            JOIN examples ON examples.id = morphs.example
+            LEFT JOIN glosses ON glosses.morph = morphs.id
+            ORDER BY morphs.id'''
+        results = []
+        lastid = None
+        for morphid, label, txt, cf, line, lang, gloss in self.db.execute(query, [pattern] * len(fields)):
+            if morphid != lastid:
+                results.append((label, txt, cf, {}, line))
+                lastid = morphid
+            if lang is not None:
+                results[-1][3][lang] = gloss
+        return results
+
+# ~~~~~~~~~~
+# Conversion
+# ~~~~~~~~~~
+
+def default_outdir():
+    '''
+    Return a new date- and time-stamped output folder next to the script.
+    '''
+    now = datetime.datetime.now()
+    newpath = str(now.year) + "-" + str(now.month).zfill(2) + "-" + str(now.day).zfill(2) + "_" + str(now.hour).zfill(2) + str(now.minute).zfill(2)
+    return os.path.join(thispath, newpath)
+
+def safe_title(rawtitle):
+    '''
+    Replace characters that are bad in file names and LaTeX.
+    '''
+    title = rawtitle        # title to use for filenames and \include{}
+    for char in illegalchars:
+        try:
+            title = title.replace(char,"_")
+        except:
+            print(char)
+            print(f'type(char) {type(char)}')
+            print(f'type(title) {type(title)}')
+    return title
+
+def iter_texts(xml_path, stream=False):
+    '''
+    Yield the <interlinear-text> elements of an export in document order.
+
+    With stream=True the file is read incrementally with iterparse and each
+    text is cleared after it has been used, so memory use stays about the same
+    however many texts the export holds.
+    '''
+    if not stream:
+        tree = xmllib.etree.parse(xml_path)
+        yield from tree.getroot().findall('interlinear-text')
+        return
+
+    root = None
+    depth = 0
+    for event, elem in xmllib.etree.iterparse(xml_path, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1 and elem.tag == 'interlinear-text':
+            yield elem
+            root.clear()    # Drop the finished text
+
+def iter_selected_texts(xml_path, only=(), guids=()):
+    '''
+    Yield the <interlinear-text> elements of an export that text_selected()
+    picks. The others are skipped in the raw bytes: only the start of each
+    text, up to its <paragraphs>, is parsed to read its titles, so the time
+    taken depends on the size of the selected texts rather than the export.
+    '''
+    def select(span):
+        end = span.find(b'<paragraphs')
+        if end < 0:
+            head = xmllib.etree.fromstring(span)
+        else:
+            head = xmllib.etree.fromstring(span[:end] + b'</interlinear-text>')
+        if text_selected(parse_titles(head), only, guids):
+            return head if end < 0 else xmllib.etree.fromstring(span)
+
+    for elem in scan_text_spans(xml_path, select):
+        if elem is not None:
+            yield elem
+
+def text_selected(text, only=(), guids=()):
+    '''
+    Is the Text in the selection: is its title abbreviation in only or its
+    guid in guids? GUIDs are compared without regard to case.
+    '''
+    return text.titleabbr in only or (text.guid or '').lower() in guids
+
+textstart = re.compile(rb'<interlinear-text(?:\s[^>]*?)?(/?)>')
+textend = b'</interlinear-text>'
+
+def scan_text_spans(xml_path, func):
+    '''
+    Return [func(span) for each <interlinear-text>] of an export, in
+    document order, where span is the raw bytes of the text; the file is
+    not parsed. This is a list rather than a generator so that the export is
+    closed again before any of it is used: Windows does not let a file that
+    is open or mapped be replaced, as a re-export during --watch would.
+    '''
+    results = []
+    if os.path.getsize(xml_path) == 0:
+        return results
+    with open(xml_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        pos = 0
+        while True:
+            m = textstart.search(data, pos)
+            if m is None:
+                break
+            if m.group(1):      # <interlinear-text/>
+                pos = m.end()
+            else:
+                pos = data.find(textend, m.end())
+                if pos < 0:
+                    break
+                pos += len(textend)
+            results.append(func(data[m.start():pos]))
+    return results
+
+def text_digests(xml_path):
+    '''
+    Return a content hash for each <interlinear-text> of an export, in
+    document order. The hashes are taken over the raw bytes of the file,
+    which is much faster than serializing the parsed elements again.
+    '''
+    return scan_text_spans(xml_path, lambda span: hashlib.sha1(span).hexdigest())
+
+def convert_text(text, langs, fourline):
+    '''
+    Render a Text in every gloss language of langs.
+
+    Returns a dict mapping each output file's role to its contents: the
+    gloss language for the glossed file, the gloss language plus
+    '-parallel' for the parallel text file, and 'community'.
+    '''
+    outputs = {}
+    for glosslang in langs:
+        glossed, parallel = render_glossed(text, glosslang, fourline)
+        outputs[glosslang] = glossed
+        if parallel is not None:
+            outputs[glosslang + '-parallel'] = parallel
+
+    # The community text does not depend on the gloss language, so it is
+    # written once, with the titles of the first language.
+    outputs['community'] = render_community(text, langs[0])
+    return outputs
+
+def load_text(source):
+    '''
+    Return source as a Text. source is a Text already, an <interlinear-text>
+    element, or one serialized with tostring().
+    '''
+    if isinstance(source, Text):
+        return source
+    if isinstance(source, bytes):
+        source = xmllib.etree.fromstring(source)
+    return parse_text(source)
+
+def init_worker(cache_size, backend):
+    '''
+    Give a worker process the settings of the main one.
+    '''
+    set_cache_size(cache_size)
+    set_xml_backend(backend)
+
+def convert_worker(source, langs, fourline, render=True, keep=False):
+    '''
+    convert_text() for a source as taken by load_text(), as run in worker
+    processes. With render=False the text is only read. With keep=True the
+    pickled Text is sent back too, for the model cache and index. The worker's process
+    id and cache stats so far are sent back along with the result.
+    '''
+    text = load_text(source)
+    outputs = convert_text(text, langs, fourline) if render else None
+    pickled = pickle.dumps(text, pickle.HIGHEST_PROTOCOL) if keep else None
+    return outputs, pickled, (os.getpid(), cache_stats())
+
+def pool_map(func, items, jobs, initializer=None, initargs=()):
+    '''
+    For each (tag, args) in items, yield (tag, func(*args)), computed in a
+    pool of jobs processes. If args is None, (tag, None) is yielded without
+    calling func. Results come back in order, and only a few tasks are
+    queued ahead so that a streamed export is not read into memory all at once.
+    '''
+    with concurrent.futures.ProcessPoolExecutor(jobs, initializer=initializer, initargs=initargs) as pool:
+        pending = collections.deque()
+        for tag, args in items:
+            pending.append((tag, None if args is None else pool.submit(func, *args)))
+            if len(pending) >= 2 * jobs:
+                tag, future = pending.popleft()
+                yield tag, future and future.result()
+        while pending:
+            tag, future = pending.popleft()
+            yield tag, future and future.result()
+
+def read_export(xml_path, model_cache=None):
+    '''
+    Return (mtime, texts): the modification time of an export and its Texts
+    in document order, from model_cache (a ModelCache, or its folder) if it
+    has them. Otherwise the XML is read, and the Texts are saved there.
+    '''
+    mtime = os.stat(xml_path).st_mtime_ns
+    if isinstance(model_cache, str):
+        model_cache = ModelCache(model_cache)
+    texts = model_cache.load(xml_path) if model_cache is not None else None
+    if texts is not None:
+        return mtime, list(texts)
+    texts = [parse_text(text) for text in iter_texts(xml_path)]
+    if model_cache is not None:
+        try:
+            cachewriter = model_cache.writer(xml_path)
+        except OSError as e:
+            sys.stderr.write(f'Not caching the models of {xml_path}: {e}\n')
+        else:
+            for text in texts:
+                cachewriter.add(text)
+            cachewriter.commit()
+    return mtime, texts
+
+def merge_exports(xml_paths, jobs=1, model_cache=None):
+    '''
+    Return the Texts of several exports as one list, with each text that is
+    in more than one of them (by GUID) only once. The copy from the export
+    modified last wins, or from the one given last if they have the same
+    mtime. Texts are in the order they first appear in, going through the
+    exports in the order given, so the result does not depend on which
+    export was read first.
+
+    With jobs > 1 the exports are read in that many processes at once (see
+    read_export()), so merging takes about as long as the slowest export.
+    '''
+    if isinstance(model_cache, ModelCache):
+        model_cache = model_cache.folder
+    xml_paths = list(xml_paths)
+    if jobs > 1 and len(xml_paths) > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+                min(jobs, len(xml_paths)), initializer=init_worker,
+                initargs=(cached_cf.maxsize, xmllib.name)) as pool:
+            exports = list(pool.map(read_export, xml_paths, [model_cache] * len(xml_paths)))
+    else:
+        exports = [read_export(xml_path, model_cache) for xml_path in xml_paths]
+
+    winners = {}    # GUID -> ((mtime, export index), Text)
+    order = []      # GUIDs, or (export index, text index) for texts without one
+    for exportidx, (mtime, texts) in enumerate(exports):
+        for textidx, text in enumerate(texts):
+            key = text.guid.lower() if text.guid else (exportidx, textidx)
+            stamp = (mtime, exportidx)
+            if key not in winners:
+                order.append(key)
+                winners[key] = (stamp, text)
+            elif stamp >= winners[key][0]:
+                winners[key] = (stamp, text)
+    return [winners[key][1] for key in order]
+
+def claim_name(fname, claimed):
+    '''
+    Return fname, with a number appended if it is already in claimed, and
+    add the result to claimed.
+    '''
+    name = fname
+    n = 2
+    while name in claimed:
+        name = fname + str(n)     # There's a better way to do this
+        n += 1
+    claimed.add(name)
+    return name
+
+def output_names(text, langs, claimed):
+    '''
+    Pick the output file names of a text, relative to the output folder,
+    with the roles used by convert_text(). Names are picked in document
+    order so that colliding titles are numbered the same way on every run.
+    '''
+    names = {}
+    for glosslang in langs:
+        fname = claim_name(f'{text.titleabbr}-{glosslang}-glossed.tex', claimed)
+        names[glosslang] = fname
+        if glosslang_formats[glosslang]['parallel'] is not None:
+            names[glosslang + '-parallel'] = claim_name(fname.replace('glossed', 'parallel'), claimed)
+    names['community'] = claim_name('community/' + safe_title(text.rawtitle) + '.tex', claimed)
+    return names
+
+def shard_names(names, langs):
+    '''
+    Add to names the \\include wrapper and standalone preview of each
+    glossed file, with the roles glosslang + '-include' and '-preview'.
+
+    These always end in .tex, as \\include{} adds it: the number that
+    claim_name() puts after the .tex of a colliding glossed file goes before
+    it instead (X-en-glossed.tex2 gets X-en-glossed2.tex). Glossed names all
+    end in glossed.tex, so this cannot collide with another text's name.
+    '''
+    for glosslang in langs:
+        stem, tex, number = names[glosslang].rpartition('.tex')
+        fname = f'{stem}{number}.tex'
+        names[glosslang + '-include'] = f'{includefolder}/{fname}'
+        names[glosslang + '-preview'] = f'{previewfolder}/{fname}'
+    return names
+
+def render_shards(names, langs):
+    '''
+    Return the wrappers and previews named by shard_names(), by role.
+    '''
+    outputs = {}
+    for glosslang in langs:
+        fname = names[glosslang]
+        outputs[glosslang + '-include'] = "\\input{" + fname + "}\n"
+        outputs[glosslang + '-preview'] = (
+            f"% {fname} on its own. Run XeLaTeX on this file from the output folder,\n"
+            f"% with the preamble of the master document in {preamblename}.tex.\n"
+            "\\input{" + preamblename + "}\n"
+            "\\begin{document}\n"
+            "\\input{" + fname + "}\n"
+            "\\end{document}\n")
+    return outputs
+
+def include_name(fname):
+    '''
+    Return the name of a wrapper as \\include{} and \\includeonly{} take it.
+    '''
+    return fname[:-len('.tex')]
+
+def converter_settings(fourline, langs):
+    '''
+    Return a digest of everything apart from the XML that goes into the
+    output: the options and this script itself.
+    '''
+    settings = json.dumps({
+        'fourline': bool(fourline),
+        'langs': langs,
+        'formats': [glosslang_formats[glosslang] for glosslang in langs],
+    }, sort_keys=True)
+    return hashlib.sha1((script_digest() + settings).encode(encoding)).hexdigest()
+
+def load_manifest(output, settings):
+    '''
+    Return the manifest left in output by an incremental run with the same
+    settings, or an empty one.
+    '''
+    empty = {'settings': settings, 'texts': []}
+    try:
+        manifest = json.loads(output.read(manifestname) or '{}')
+    except ValueError:
+        return empty
+    if manifest.get('settings') != settings:
+        return empty
+    return manifest
+
+def convert(xml_path, out_dir, fourline=True, langs=glosslangs, stream=False, jobs=1,
+            incremental=False, model_cache=None, on_text=None, only=None, guids=None,
+            index=None, background=True, fsync=False, shards=False):
+    '''
+    Convert the FLEx XML export in xml_path into LaTeX files in out_dir,
+    which is a folder or a FileOutput or MemoryOutput. xml_path can also be
+    a list of exports, which are merged into one set of texts (see
+    merge_exports()); stream does not apply then.
+
+    One glossed file is written per text and gloss language in langs, plus
+    parallel and community files and an __inputs.tex that \\input{}s the
+    glossed files. Each text is read once and then written in every language.
+    With stream=True the export is read one text at a time (see iter_texts()).
+    With jobs > 1 the texts are rendered in that many processes; the output
+    is the same as with jobs=1.
+
+    With incremental=True, out_dir keeps a manifest of the content hash of
+    each <interlinear-text>, and only the texts that changed since the last
+    incremental run with the same settings are written again. Files of texts
+    that are gone are removed.
+
+    model_cache is a ModelCache or its folder. If it holds the models of this
+    export they are used instead of reading the XML; if not, they are saved
+    there as the export is read. A ModelStore can be given too.
+
+    With only (title abbreviations) or guids, just the texts that match either
+    are converted, and the rest of the export is skipped without being
+    parsed (see iter_selected_texts()). This cannot be combined with
+    incremental=True.
+
+    With shards=True, each glossed file also gets an \\include wrapper and a
+    standalone preview document (see shard_names()), and __includes.tex
+    \\include{}s the wrappers in the order of __inputs.tex. __includeonly.tex
+    holds an \\includeonly{} of the texts written in this run, so that a
+    master document built on __includes.tex only compiles those again.
+
+    Files on disk are written by a BackgroundWriter unless background=False,
+    each by way of a temporary file that is renamed into place; with
+    fsync=True they are also fsynced first.
+
+    index, a MorphIndex or the path of its database, is given every text
+    that is converted (all of them with incremental=True too).
+
+    on_text, if given, is called as on_text(text, seconds) for each text that
+    is written, with its Text (only the titles, if it was read in a worker)
+    and the time taken to read, render and write it.
+
+    Returns the path of __inputs.tex.
+    '''
+    if not langs:
+        raise ValueError('no gloss languages given')
+    for glosslang in langs:
+        if glosslang not in glosslang_formats:
+            raise ValueError(f'unsupported gloss language: {glosslang}')
+    langs = tuple(langs)
+    selecting = bool(only or guids)
+    if selecting:
+        if incremental:
+            raise ValueError('a selection of texts cannot be converted incrementally')
+        only = set(only or ())
+        guids = {guid.lower() for guid in guids or ()}
+
+    output = out_dir
+    if isinstance(out_dir, str):
+        output = FileOutput(out_dir, sync=fsync)
+
+    previous = {}       # content hash -> manifest entry, from the last run
+    texts = []          # manifest entries for this run
+    if incremental:
+        settings = converter_settings(fourline, langs)
+        for entry in load_manifest(output, settings)['texts']:
+            previous.setdefault(entry['hash'], entry)
+        # Until the new manifest is written, a rerun must not trust the old one.
+        output.remove(manifestname)
+    claimed = set()
+    merging = not isinstance(xml_path, str)
+    export = (' + '.join(os.path.abspath(path) for path in xml_path) if merging
+              else os.path.abspath(xml_path))
+    digests = iter(text_digests(xml_path) if incremental and not merging else ())
+
+    sources = None      # cached Texts, or else the <interlinear-text> elements
+    cachewriter = None
+    if merging:
+        sources = merge_exports(xml_path, jobs, model_cache)
+        if selecting:
+            sources = [text for text in sources if text_selected(text, only, guids)]
+    elif model_cache is not None:
+        if isinstance(model_cache, str):
+            model_cache = ModelCache(model_cache)
+        sources = model_cache.load(xml_path)
+        if sources is not None and selecting:
+            sources = (text for text in sources if text_selected(text, only, guids))
+        if sources is None and not selecting:
+            try:
+                cachewriter = model_cache.writer(xml_path)
+            except OSError as e:
+                sys.stderr.write(f'Not caching the models of {xml_path}: {e}\n')
+    if sources is None:
+        if selecting:
+            sources = iter_selected_texts(xml_path, only, guids)
+        else:
+            sources = iter_texts(xml_path, stream=stream)
+    found = set()       # title abbreviations and guids of the selected texts
+
+    closeindex = isinstance(index, str)
+    if closeindex:
+        index = MorphIndex(index)
+    if index is not None:
+        index.begin(export)
+    keep = cachewriter is not None or index is not None   # need every text read
+
+    def tasks():
+        '''
+        Yield ((titles, names), source, render) for each text. render is
+        False if the text's files are up to date, and source is None if
+        nothing needs to be done with the text at all.
+        '''
+        for source in sources:
+            titles = source if isinstance(source, Text) else parse_titles(source)
+            if selecting:
+                found.update((titles.titleabbr, (titles.guid or '').lower()))
+            names = output_names(titles, langs, claimed)
+            if shards:
+                shard_names(names, langs)
+            render = True
+            if incremental:
+                digest = next(digests, None) or hashlib.sha1(
+                    pickle.dumps(source) if isinstance(source, Text) else xmllib.etree.tostring(source)).hexdigest()
+                texts.append({'hash': digest, 'files': names})
+                entry = previous.get(digest)
+                if entry is not None and entry['files'] == names and all(
+                        output.exists(fname) for fname in names.values()):
+                    render = False
+            if not render and not keep:
+                source = None
+            yield (titles, names), source, render
+
+    workerstats = {}    # worker process id -> its latest cache stats
+    if jobs > 1:
+        def unpack(workerresults):
+            for tag, workerresult in workerresults:
+                if workerresult is None:
+                    yield tag, None
+                    continue
+                result, pickled, (pid, stats) = workerresult
+                workerstats[pid] = stats
+                if cachewriter is not None:
+                    cachewriter.add(pickled)
+                if index is not None:
+                    index.add(pickle.loads(pickled), pickled)
+                yield tag, result
+        results = unpack(pool_map(
+            convert_worker,
+            ((tag, None if source is None else (
+                source if isinstance(source, Text) else xmllib.etree.tostring(source),
+                langs, fourline, render, keep))
+             for tag, source, render in tasks()),
+            jobs,
+            initializer=init_worker,
+            initargs=(cached_cf.maxsize, xmllib.name)
+        ))
+    else:
+        def convert_all():
+            for (titles, names), source, render in tasks():
+                outputs = None
+                if source is not None:
+                    text = load_text(source)
+                    if cachewriter is not None:
+                        cachewriter.add(text)
+                    if index is not None:
+                        index.add(text)
+                    if render:
+                        outputs = convert_text(text, langs, fourline)
+                        titles = text
+                yield (titles, names), outputs
+        results = convert_all()
+
+    inputs = {glosslang: [] for glosslang in langs}
+    includes = {glosslang: [] for glosslang in langs}  # wrapper names, with shards
+    written = set()     # names of the wrappers of the texts written in this run
+
+    # Only started now, so that nothing above can leave its threads behind;
+    # every way out from here on closes it.
+    writer = None
+    if background and isinstance(output, FileOutput):
+        output = writer = BackgroundWriter(output)
+
+    # ~~~~~~~~~~~~~~~~~~~~
+    # Go through each text
+    # ~~~~~~~~~~~~~~~~~~~~
+    try:
+        start = time.perf_counter()
+        for (titles, names), outputs in results:
+            for glosslang in langs:
+                inputs[glosslang].append(names[glosslang])
+                if shards:
+                    includes[glosslang].append(names[glosslang + '-include'])
+            if outputs is not None:
+                if shards:
+                    outputs.update(render_shards(names, langs))
+                    written.update(names[glosslang + '-include'] for glosslang in langs)
+                # Write out a new output file for each text
+                for role, content in outputs.items():
+                    output.write(names[role], content)
+                if on_text is not None:
+                    on_text(titles, time.perf_counter() - start)
+            start = time.perf_counter()
+    except BaseException:
+        if cachewriter is not None:
+            cachewriter.discard()
+        if closeindex:
+            index.close()
+        if writer is not None:
+            try:
+                writer.close()      # Still write the texts that were done
+            except Exception:
+                pass
+        raise
+
+    try:
+        if cachewriter is not None:
+            cachewriter.commit()
+        if index is not None:
+            index.end(complete=not selecting)
+            if closeindex:
+                index.close()
+        if selecting:
+            for wanted in sorted((only | guids) - found):
+                sys.stderr.write(f'{", ".join(xml_path) if merging else xml_path}: no text {wanted}\n')
+
+        for stats in workerstats.values():
+            for name, cache in format_caches.items():
+                cache.absorb(stats[name])
+
+        #masterfile.write("\\newcommand{\\texttitle}[1]{\chapter{#1}\setcounter{equation}{0}}\n")
+        master = ''.join(
+            "\\input{" + fname + "}\n"
+            for glosslang in langs
+            for fname in inputs[glosslang]
+        )
+        if writer is not None:
+            writer.wait()   # Only list texts whose files are written
+        output.write(masterfilename, master)
+        if shards:
+            output.write(includesfilename, ''.join(
+                "\\include{" + include_name(fname) + "}\n"
+                for glosslang in langs
+                for fname in includes[glosslang]
+            ))
+            output.write(includeonlyfilename, "\\includeonly{" + ','.join(
+                include_name(fname)
+                for glosslang in langs
+                for fname in includes[glosslang]
+                if fname in written
+            ) + "}\n")
+
+        if incremental:
+            if not shards:
+                output.remove(includesfilename)
+                output.remove(includeonlyfilename)
+            # Remove the files of texts that are no longer in the export
+            current = {fname for entry in texts for fname in entry['files'].values()}
+            for entry in previous.values():
+                for fname in entry['files'].values():
+                    if fname not in current:
+                        output.remove(fname)
+
+            output.write(manifestname, json.dumps({'settings': settings, 'texts': texts}, indent=1))
+    finally:
+        if writer is not None:
+            writer.close()
+    return os.path.join(output.path, masterfilename)
+
+# ~~~~~~~~~
+# Profiling
+# ~~~~~~~~~
+
+class Profiler:
+    '''
+    Wall time and call counts for each stage of the conversion, and time
+    spent on each text and paragraph.
+
+    enable() replaces the functions of each stage in this module with timed
+    wrappers and disable() puts them back, so the conversion code has no
+    timing calls of its own and costs nothing extra when not profiling.
+    Stage times are inclusive: orthography time is also counted in the
+    first line and morpheme stages it is called from. Only the main thread
+    of the main process is profiled, so run with jobs=1 and background=False.
+    A text loaded from the model cache is timed as a whole, in the model
+    cache stage, as it has no XML to parse.
+    '''
+
+    # stage -> names of the module functions it is made of
+    stages = {
+        'xml parsing': ('iter_texts', 'iter_selected_texts', 'scan_text_spans'),
+        'first line': ('parse_firstline',),
+        'morphemes': ('parse_words',),
+        'orthography': ('replace_tones', 'replace_spellings', 'replace_nums'),
+        'rendering': ('convert_text',),
+    }
+    iterators = {'iter_texts', 'iter_selected_texts'}   # timed per item
+
+    # stage -> (class, method) pairs it is made of
+    methods = {
+        'model cache': ((ModelCache, 'load'), (ModelCache, 'texts')),
+        'output': ((FileOutput, 'write'), (MemoryOutput, 'write')),
+    }
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.times = collections.Counter()
+        self.texts = []             # [label, seconds] per text
+        self.paragraphs = []        # (seconds, label) per paragraph
+        self.pending = 0.0          # XML parsing time of the text still to come
+        self.pendingparagraphs = []
+        self.depth = collections.Counter()  # stage -> timed calls of it running
+        self.unpickled = []         # seconds per Text read by the last ModelCache.load()
+        self.saved = {}
+
+    def add(self, stage, elapsed):
+        self.calls[stage] += 1
+        self.times[stage] += elapsed
+
+    def timed(self, stage, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            self.depth[stage] += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.depth[stage] -= 1
+                if not self.depth[stage]:
+                    elapsed = time.perf_counter() - start
+                    self.add(stage, elapsed)
+                    if stage in ('rendering', 'output') and self.texts:
+                        self.texts[-1][1] += elapsed
+        return wrapper
+
+    def timed_iter(self, stage, func):
+        '''
+        Time each item of the iterator func returns. As in timed(), a call
+        made from within another of the same stage (the spans that
+        iter_selected_texts() scans) is only counted in the outer one.
+        '''
+        def wrapper(*args, **kwargs):
+            items = func(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                self.depth[stage] += 1
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    self.depth[stage] -= 1
+                    if not self.depth[stage]:
+                        elapsed = time.perf_counter() - start
+                        self.add(stage, elapsed)
+                        self.pending += elapsed
+                yield item
+        return wrapper
+
+    def timed_models(self, stage, func):
+        '''
+        Like timed(), for ModelCache.load(). The Texts it returns are each
+        recorded as a text when they are used, with the time it took to
+        unpickle them (see timed_unpickle()).
+        '''
+        def wrapper(*args, **kwargs):
+            self.unpickled = []
+            texts = self.timed(stage, func)(*args, **kwargs)
+            return None if texts is None else self.recorded(texts, self.unpickled)
+        return wrapper
+
+    def timed_unpickle(self, stage, func):
+        '''
+        Count each Text that ModelCache.texts() reads and keep its time for
+        timed_models(); the time itself is counted in ModelCache.load().
+        '''
+        def wrapper(*args, **kwargs):
+            items = func(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                self.calls[stage] += 1
+                self.unpickled.append(time.perf_counter() - start)
+                yield item
+        return wrapper
+
+    def recorded(self, texts, times):
+        for text, elapsed in zip(texts, times):
+            self.texts.append([text.titleabbr, self.pending + elapsed])
+            self.pending = 0.0
+            yield text
+
+    def timed_paragraph(self, func):
+        def wrapper(paragraph):
+            start = time.perf_counter()
+            model = func(paragraph)
+            self.pendingparagraphs.append(time.perf_counter() - start)
+            return model
+        return wrapper
+
+    def timed_text(self, func):
+        def wrapper(text):
+            start = time.perf_counter()
+            model = func(text)
+            self.texts.append([model.titleabbr, self.pending + time.perf_counter() - start])
+            self.pending = 0.0
+            for paragraphidx, elapsed in enumerate(self.pendingparagraphs, 1):
+                self.paragraphs.append((elapsed, f'ex:{model.titleabbr}{paragraphidx}'))
+            self.pendingparagraphs = []
+            return model
+        return wrapper
+
+    def enable(self):
+        module = globals()
+        wrappers = {
+            'parse_text': self.timed_text(module['parse_text']),
+            'parse_paragraph': self.timed_paragraph(module['parse_paragraph']),
+        }
+        for stage, names in self.stages.items():
+            for name in names:
+                if name in self.iterators:
+                    wrappers[name] = self.timed_iter(stage, module[name])
+                else:
+                    wrappers[name] = self.timed(stage, module[name])
+        for name, wrapper in wrappers.items():
+            self.saved[name] = module[name]
+            module[name] = wrapper
+        for stage, methods in self.methods.items():
+            for cls, name in methods:
+                func = cls.__dict__[name]
+                self.saved[cls, name] = func
+                if (cls, name) == (ModelCache, 'load'):
+                    setattr(cls, name, self.timed_models(stage, func))
+                elif (cls, name) == (ModelCache, 'texts'):
+                    setattr(cls, name, self.timed_unpickle(stage, func))
+                else:
+                    setattr(cls, name, self.timed(stage, func))
+
+    def disable(self):
+        module = globals()
+        for name, func in self.saved.items():
+            if isinstance(name, str):
+                module[name] = func
+            else:
+                setattr(*name, func)
+        self.saved = {}
+
+    def results(self, top=10):
+        return {
+            'stages': {stage: {'calls': self.calls[stage], 'seconds': self.times[stage]}
+                       for stage in list(self.stages) + list(self.methods)},
+            'texts': [{'text': label, 'seconds': elapsed}
+                      for label, elapsed in sorted(self.texts, key=lambda t: -t[1])[:top]],
+            'paragraphs': [{'paragraph': label, 'seconds': elapsed}
+                           for elapsed, label in sorted(self.paragraphs, reverse=True)[:top]],
+        }
+
+    def report(self, top=10):
+        '''
+        Return a readable summary of the stages and the slowest texts and paragraphs.
+        '''
+        results = self.results(top)
+        lines = [f'{"stage":<12} {"calls":>9} {"time":>10}']
+        for stage, result in results['stages'].items():
+            lines.append(f'{stage:<12} {result["calls"]:>9} {result["seconds"]:>9.3f}s')
+        lines.append('')
+        lines.append('slowest texts:')
+        for result in results['texts']:
+            lines.append(f'  {result["text"]:<20} {result["seconds"]:>9.3f}s')
+        lines.append('slowest paragraphs (reading only):')
+        for result in results['paragraphs']:
+            lines.append(f'  {result["paragraph"]:<20} {result["seconds"]:>9.3f}s')
+        if not results['paragraphs'] and self.calls['model cache']:
+            lines.append('  none read: the texts came from the model cache (--no-model-cache to time them)')
+        return '\n'.join(lines) + '\n'
+
+# ~~~~~~~~~~
+# Watch mode
+# ~~~~~~~~~~
+
+def export_files(paths):
+    '''
+    Return the exports named by paths: files as they are, and the .xml files
+    in folders, sorted.
+    '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.lower().endswith('.xml')))
+        else:
+            files.append(path)
+    return files
+
+def export_outdirs(outdir, xmlfiles, several, folders=None):
+    '''
+    Return {xmlfile: output folder} for xmlfiles: outdir, or if there are
+    several exports, a subfolder of it named after each. Exports with the
+    same file name (in different folders) are numbered in the order given,
+    as colliding texts are (see claim_name()). folders, if given, holds the
+    folders picked by earlier calls; they are kept, and not given out again.
+    '''
+    if folders is None:
+        folders = {}
+    claimed = {os.path.basename(folder) for folder in folders.values()}
+    for xmlfile in xmlfiles:
+        if xmlfile in folders:
+            continue
+        if several:
+            name = claim_name(os.path.splitext(os.path.basename(xmlfile))[0], claimed)
+            folders[xmlfile] = os.path.join(outdir, name)
+        else:
+            folders[xmlfile] = outdir
+    return folders
+
+def rebuild(xmlfile, out_dir, store, **options):
+    '''
+    Convert xmlfile incrementally with the Texts in store, and return a
+    status line naming the texts that were written and how long each took.
+    '''
+    written = []
+    start = time.perf_counter()
+    try:
+        convert(xmlfile, out_dir, incremental=True, model_cache=store,
+                on_text=lambda text, seconds: written.append(f'{text.titleabbr} {seconds * 1000:.0f}ms'),
+                **options)
+    except (OSError,) + xmllib.errors as e:
+        return f'{xmlfile}: {e}'
+    line = (f'[{datetime.datetime.now():%H:%M:%S}] {xmlfile}: {len(written)} of '
+            f'{len(store.exports.get(xmlfile, ()))} texts written in {time.perf_counter() - start:.2f}s')
+    if written:
+        line += ': ' + ', '.join(written[:10])
+        if len(written) > 10:
+            line += f' and {len(written) - 10} more'
+    return line
+
+def watch(paths, outdir, interval=1.0, **options):
+    '''
+    Convert the exports named by paths (files, or folders of them) into
+    outdir, then check them every interval seconds and convert each one
+    again when it changes, until interrupted. options are passed on to
+    convert().
+
+    The Texts are kept in a ModelStore and the output is written
+    incrementally, so a rebuild only reads and writes the texts whose
+    content changed. A changed export is converted once its size and mtime
+    have stayed the same for an interval, so that one FLEx is still writing
+    is not picked up half-way.
+    '''
+    store = ModelStore()
+    several = len(paths) > 1 or any(os.path.isdir(path) for path in paths)
+    built = {}      # export -> (size, mtime) it was last converted at
+    folders = {}    # export -> its output folder, kept while watching
+    seen = {}       # export -> (size, mtime) at the last check
+    first = True
+    while True:
+        files = export_files(paths)
+        export_outdirs(outdir, files, several, folders)
+        for xmlfile in set(built) - set(files):
+            del built[xmlfile]
+            store.forget(xmlfile)
+        for xmlfile in files:
+            try:
+                st = os.stat(xmlfile)
+            except OSError:
+                continue
+            stamp = (st.st_size, st.st_mtime_ns)
+            if built.get(xmlfile) == stamp:
+                continue
+            if not first and seen.get(xmlfile) != stamp:
+                seen[xmlfile] = stamp     # Wait for it to settle
+                continue
+            built[xmlfile] = stamp
+            print(rebuild(xmlfile, folders[xmlfile], store, **options), flush=True)
+        first = False
+        time.sleep(interval)
+
+# ~~~~~~~~~~~~
+# Entry points
+# ~~~~~~~~~~~~
+
+def gui():
+    '''
+    Ask for options and an XML file with Tk, then convert it.
+    '''
+    if tkinter is None:
+        sys.exit("Tk is not available; pass XML files on the command line instead.")
+    app = Application()
+    app.mainloop()
+    if not app.makedic: return
+
+    xmlfilemsg = "XML file from FLEx?"
+    xmlfile = filedialog.askopenfilename(title = xmlfilemsg)
+
+    if not xmlfile: return
+
+    fourline = app.morphbox.get()       # Are we doing a 4-line interlinearization?
+
+    app.master.destroy()
+
+    try:
+        convert(xmlfile, default_outdir(), fourline=fourline, model_cache=default_model_cache)
+    except (OSError,) + xmllib.errors:
+        print("No XML file found. Exiting.")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert interlinearized FLEx XML exports into LaTeX. '
+                    'With no XML files, a file dialog is shown.')
+    parser.add_argument('xmlfiles', nargs='*', metavar='XML',
+                        help='"Verifiable generic XML" export(s) from FLEx, or folders of them')
+    parser.add_argument('-o', '--outdir',
+                        help='output folder (default: a new date-stamped folder next to the script); '
+                             'with several XML files or a folder, each is written to a subfolder named after it '
+                             '(numbered if two have the same name)')
+    parser.add_argument('--merge', action='store_true',
+                        help='convert all the XML files together into one --outdir, with one __inputs.tex; '
+                             'a text (by GUID) in several of them is taken from the one modified last')
+    parser.add_argument('--twoline', action='store_true',
+                        help='write 2-line instead of 4-line interlinearization')
+    parser.add_argument('--stream', action='store_true',
+                        help='read the XML one text at a time to keep memory use low on very large exports')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only rewrite the texts that changed since the last --incremental run into the same --outdir')
+    parser.add_argument('--only', action='append', metavar='ABBR[,ABBR...]',
+                        help='only convert the texts with these title abbreviations; the rest of the export is skipped')
+    parser.add_argument('--guid', action='append', metavar='GUID[,GUID...]',
+                        help='only convert the texts with these GUIDs (with --only: texts matching either)')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running, and convert each export again when it changes, '
+                             'rewriting only the texts that changed')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between checks for changes with --watch (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes to convert texts with (0: one per CPU; default: %(default)s)')
+    parser.add_argument('--model-cache', metavar='DIR', default=default_model_cache,
+                        help='folder to keep the texts read from each export in, so that converting '
+                             'it again skips the XML (default: %(default)s)')
+    parser.add_argument('--no-model-cache', dest='model_cache', action='store_const', const=None,
+                        help='always read the XML, and do not save what was read')
+    parser.add_argument('--xml-backend', choices=('etree', 'lxml', 'auto'), default='etree',
+                        help='XML library to read exports with; auto uses lxml if it is installed (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=default_cache_size,
+                        help='number of formatted cfs and glosses to cache (0 disables caching; default: %(default)s)')
+    parser.add_argument('--stats', action='store_true',
+                        help='report formatting cache hits, misses and time saved when done')
+    parser.add_argument('--profile', action='store_true',
+                        help='report time spent per stage and the slowest texts and paragraphs (runs in one process)')
+    parser.add_argument('--profile-json', metavar='FILE',
+                        help='write the --profile results to FILE as JSON (implies --profile)')
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help='run the conversion under cProfile and save the stats to FILE')
+    parser.add_argument('--langs', default=','.join(glosslangs),
+                        help='comma-separated gloss languages (default: %(default)s)')
+    parser.add_argument('--shards', action='store_true',
+                        help='also write an \\include wrapper and a standalone preview of each text, '
+                             f'{includesfilename} to \\include them and {includeonlyfilename} '
+                             'with an \\includeonly of the texts written in this run')
+    parser.add_argument('--fsync', action='store_true',
+                        help='fsync each output file before renaming it into place, so that written files '
+                             'survive a crash or power loss')
+    parser.add_argument('--index', metavar='FILE',
+                        help='also add each converted text to the SQLite morpheme index FILE')
+    parser.add_argument('--lookup', metavar='TERM',
+                        help='instead of converting, list the morphemes in --index whose form, cf or gloss '
+                             'is TERM (* and ? are wildcards)')
+    parser.add_argument('--lookup-field', choices=('any', 'txt', 'cf', 'gloss'), default='any',
+                        help='only match TERM against this field with --lookup (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    if args.lookup is not None:
+        if not args.index:
+            parser.error('--lookup needs an --index')
+        if not os.path.exists(args.index):
+            parser.error(f'no index at {args.index}')
+        index = MorphIndex(args.index)
+        for label, txt, cf, glosses, line in index.lookup(args.lookup, args.lookup_field):
+            glosses = ', '.join(f'{lang}: {gloss}' for lang, gloss in glosses.items())
+            print(f'{label}\t{txt}\t{cf or ""}\t{glosses}\t{line}')
+        index.close()
+        return 0
+
+    if not args.xmlfiles:
+        gui()
+        return 0
+
+    langs = tuple(l for l in args.langs.split(',') if l)
+    for glosslang in langs:
+        if glosslang not in glosslang_formats:
+            parser.error(f'unsupported gloss language: {glosslang}')
+
+    if args.incremental and not args.outdir:
+        parser.error('--incremental needs a fixed --outdir')
+    only = {abbr for value in args.only or () for abbr in value.split(',') if abbr}
+    guids = {guid for value in args.guid or () for guid in value.split(',') if guid}
+    if (only or guids) and (args.incremental or args.watch):
+        parser.error('--only and --guid cannot be used with --incremental or --watch')
+    if args.merge and args.watch:
+        parser.error('--merge cannot be used with --watch')
+    jobs = args.jobs or os.cpu_count() or 1
+    set_cache_size(args.cache_size)
+    try:
+        set_xml_backend(args.xml_backend)
+    except ValueError as e:
+        parser.error(str(e))
+    profiler = None
+    if args.profile or args.profile_json:
+        if jobs > 1:
+            sys.stderr.write('--profile: converting in a single process\n')
+            jobs = 1
+        profiler = Profiler()
+        profiler.enable()
+    cprofiler = None
+    if args.cprofile:
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+
+    outdir = args.outdir or default_outdir()
+    status = 0
+    if args.watch:
+        print(f'Watching {", ".join(args.xmlfiles)}; writing to {outdir}. Press Ctrl-C to stop.', flush=True)
+        try:
+            watch(args.xmlfiles, outdir, args.interval, fourline=not args.twoline, langs=langs, jobs=jobs,
+                  index=args.index, fsync=args.fsync, shards=args.shards)
+        except KeyboardInterrupt:
+            pass
+    else:
+        several = len(args.xmlfiles) > 1 or any(os.path.isdir(path) for path in args.xmlfiles)
+        if args.merge:
+            xmlfiles = export_files(args.xmlfiles)
+            runs = [(', '.join(xmlfiles), xmlfiles, outdir)]
+        else:
+            xmlfiles = export_files(args.xmlfiles)
+            folders = export_outdirs(outdir, xmlfiles, several)
+            runs = [(xmlfile, xmlfile, folders[xmlfile]) for xmlfile in xmlfiles]
+        for name, xmlfile, xmloutdir in runs:
+            try:
+                convert(xmlfile, xmloutdir, fourline=not args.twoline,
+                        langs=langs, stream=args.stream, jobs=jobs, incremental=args.incremental,
+                        model_cache=args.model_cache, only=only, guids=guids, index=args.index,
+                        background=profiler is None, fsync=args.fsync, shards=args.shards)
+            except (OSError,) + xmllib.errors as e:
+                sys.stderr.write(f'{name}: {e}\n')
+                status = 1
+    if cprofiler is not None:
+        cprofiler.disable()
+        cprofiler.dump_stats(args.cprofile)
+    if profiler is not None:
+        profiler.disable()
+        sys.stderr.write(profiler.report())
+        if args.profile_json:
+            with open(args.profile_json, 'w', encoding=encoding) as f:
+                json.dump(profiler.results(top=None), f, indent=1)
+    if args.stats:
+        sys.stderr.write(format_cache_stats())
+    return status
+
+if __name__ == '__main__':
+    # Run as the interlinearized module rather than __main__, so that the
+    # Texts in the model cache are pickled under the same name as by code
+    # that imports it, and either can read what the other wrote.
+    import interlinearized
+    sys.exit(interlinearized.main())